@@ -0,0 +1,76 @@
+#!/usr/bin/env python2
+
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Compare the power control engines on a simulated node.
+
+Replays a schedule of power targets through the Controller, on top of a
+simulated dual socket node whose second socket changes phase halfway, and
+reports per target the convergence time, overshoot and steady state error,
+along with the controller cost per tick."""
+
+from __future__ import print_function
+import argparse
+import sys
+from nrm.controller import Controller, PowerActuator, control_engines
+from nrm.simulation import PowerModel, SimulatedSensorManager, replay
+
+
+def node(args):
+    half = args.duration / 2.0
+    models = {
+        'package-0': PowerModel([(0, 150.0)], noise=args.noise),
+        'package-1': PowerModel([(0, 50.0), (half, 140.0)],
+                                noise=args.noise),
+        'package-0/dram': PowerModel([(0, 20.0)], controlled=False),
+    }
+    return SimulatedSensorManager(models, period=args.period / 1000.0,
+                                  seed=args.seed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-e", "--engine", action='append',
+                        choices=sorted(control_engines.keys()),
+                        help="control engine(s) to evaluate, default: all")
+    parser.add_argument("-p", "--period", type=float, default=1000.0,
+                        help="control period, in milliseconds")
+    parser.add_argument("-n", "--noise", type=float, default=1.0,
+                        help="power measurement noise, in watts")
+    parser.add_argument("-d", "--duration", type=float, default=120.0,
+                        help="simulated duration, in seconds")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="random seed for the measurement noise")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.05,
+                        help="relative tolerance band for convergence")
+    args = parser.parse_args(argv)
+
+    d = args.duration
+    targets = [(0, 200.0), (d / 4.0, 150.0), (3 * d / 4.0, 260.0)]
+    for name in args.engine or sorted(control_engines.keys()):
+        sm = node(args)
+        controller = Controller([PowerActuator(sm, control_engines[name]())])
+        results = replay(controller, sm, targets, d, args.tolerance)
+        print("engine %s: cost mean %.1f us, max %.1f us" %
+              (name, results['cost']['mean'] * 1000000.0,
+               results['cost']['max'] * 1000000.0))
+        for r in results['targets']:
+            conv = r['convergence']
+            print("  t=%6.1f s target %6.1f W  convergence %6s s  "
+                  "overshoot %5.1f W  error %5.2f W" %
+                  (r['start'], r['target'],
+                   "never" if conv is None else "%.1f" % conv,
+                   r['overshoot'], r['error']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
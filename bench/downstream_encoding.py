@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Compare the encodings of the downstream event API.
+
+For each high rate downstream message, reports the size on the wire and the
+time to encode and decode it in each encoding, with and without schema
+validation on the receiving side. The batch holds 64 progress events."""
+
+from __future__ import print_function
+import argparse
+import sys
+import timeit
+import uuid
+import nrm.messaging
+
+API = 'downstreamEvent'
+
+
+def messages():
+    cid = str(uuid.uuid4())
+    aid = str(uuid.uuid4())
+    progress = {'tag': 'progress', 'payload': 1, 'application_uuid': aid}
+    return [
+        progress,
+        {'tag': 'performance', 'payload': 42.5, 'container_uuid': cid,
+         'application_uuid': aid},
+        {'tag': 'phasecontext', 'cpu': 63, 'startcompute': 1556125412.125,
+         'endcompute': 1556125412.25, 'startbarrier': 1556125412.25,
+         'endbarrier': 1556125412.375, 'application_uuid': aid},
+        {'tag': 'batch', 'events': [progress] * 64},
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--number", type=int, default=10000,
+                        help="iterations per measurement")
+    args = parser.parse_args(argv)
+
+    print("%-13s %-7s %6s %10s %10s %10s" %
+          ("tag", "format", "bytes", "encode us", "decode us", "+valid us"))
+    for msg in messages():
+        for encoding in nrm.messaging.encodings:
+            wire = nrm.messaging.encode(API, msg, encoding)
+
+            def enc():
+                nrm.messaging.encode(API, msg, encoding)
+
+            def dec():
+                nrm.messaging.message(API, nrm.messaging.decode(API, wire),
+                                      validate=False)
+
+            def val():
+                nrm.messaging.message(API, nrm.messaging.decode(API, wire))
+
+            times = [timeit.timeit(f, number=args.number) / args.number
+                     for f in (enc, dec, val)]
+            print("%-13s %-7s %6d %10.2f %10.2f %10.2f" %
+                  ((msg['tag'], encoding, len(wire)) +
+                   tuple(t * 1000000.0 for t in times)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python2
+
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Measure the period jitter of an nrmd-style periodic callback.
+
+Runs a tornado PeriodicCallback at the requested period, optionally doing a
+full SensorManager update on each tick (this requires access to the RAPL and
+hwmon sysfs), and reports the achieved period and the per-tick cost."""
+
+from __future__ import print_function
+import argparse
+import sys
+import time
+from zmq.eventloop import ioloop
+from nrm.telemetry import RingBuffer
+
+
+def report(name, ring, scale=1000.0, unit="ms"):
+    print("%-8s mean %8.3f %s  std %8.3f %s  p50 %8.3f %s  p99 %8.3f %s  "
+          "max %8.3f %s" % (name,
+                            ring.mean() * scale, unit,
+                            ring.window().std() * scale, unit,
+                            ring.percentile(50) * scale, unit,
+                            ring.percentile(99) * scale, unit,
+                            ring.max() * scale, unit))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-p", "--period", type=float, default=10.0,
+                        help="callback period, in milliseconds")
+    parser.add_argument("-d", "--duration", type=float, default=10.0,
+                        help="benchmark duration, in seconds")
+    parser.add_argument("-s", "--sensors", action='store_true',
+                        help="update the node sensors on each tick")
+    parser.add_argument("-t", "--thread", action='store_true',
+                        help="update the sensors from a sampler thread")
+    args = parser.parse_args(argv)
+
+    ticks = int(args.duration * 1000.0 / args.period)
+    periods = RingBuffer(ticks)
+    costs = RingBuffer(ticks)
+    state = {'last': None}
+
+    update = None
+    sampler = None
+    if args.sensors:
+        import nrm.sensor
+        sm = nrm.sensor.SensorManager()
+        sm.start()
+        update = sm.do_update
+        if args.thread:
+            sampler = nrm.sensor.SensorSampler(sm, args.period / 1000.0)
+            sampler.start()
+            update = None
+
+    def tick():
+        start = time.time()
+        if state['last'] is not None:
+            periods.append(start, start - state['last'])
+        state['last'] = start
+        if update:
+            update()
+        elif sampler:
+            state['snapshot'] = sampler.snapshot
+        costs.append(start, time.time() - start)
+        if costs.count >= ticks:
+            ioloop.IOLoop.current().stop()
+
+    cb = ioloop.PeriodicCallback(tick, args.period)
+    cb.start()
+    ioloop.IOLoop.current().start()
+    if sampler:
+        sampler.stop()
+
+    print("target period: %g ms, %d ticks" % (args.period, len(costs)))
+    report("period", periods)
+    jitter = RingBuffer(len(periods))
+    for t, p in zip(*periods.ordered()):
+        jitter.append(t, abs(p - args.period / 1000.0))
+    report("jitter", jitter)
+    report("cost", costs, scale=1000000.0, unit="us")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,8 +9,16 @@
 ###############################################################################
 
 """Parse and Represent the APPC ACI specification."""
+from collections import OrderedDict
 import logging
+import os
 from schema import loadschema
+import yaml
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader
 
 logger = logging.getLogger('nrm')
 
@@ -21,3 +29,40 @@ def has(self, f):
 
 ImageManifest = loadschema("yml", "manifest")
 setattr(ImageManifest, "is_feature_enabled", has)
+
+
+class ManifestCache(object):
+
+    """Parsed and validated manifests, indexed by file.
+
+    A manifest is parsed again only if its file changed (different
+    modification time or size) since it was cached. The least recently used
+    manifests are evicted past size entries. Cached manifests are shared by
+    all the callers, and must not be modified."""
+
+    def __init__(self, manifest_class=None, size=64):
+        self.manifest_class = manifest_class or ImageManifest
+        self.size = size
+        self.manifests = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """Return the manifest in a file, parsing it if needed."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+        try:
+            cached, manifest = self.manifests.pop(path)
+        except KeyError:
+            cached = None
+        if cached == key:
+            self.hits += 1
+        else:
+            self.misses += 1
+            with open(path) as f:
+                manifest = self.manifest_class(yaml.load(f, Loader=Loader))
+        self.manifests[path] = (key, manifest)
+        while len(self.manifests) > self.size:
+            self.manifests.popitem(last=False)
+        return manifest
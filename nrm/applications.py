@@ -15,6 +15,41 @@ import logging
 logger = logging.getLogger('nrm')
 
 
+class ReportWindow(object):
+
+    """Accumulates the values reported by an application between two
+    summaries."""
+
+    def __init__(self, start):
+        self.reset(start)
+
+    def reset(self, start):
+        self.start = start
+        self.total = 0.0
+        self.count = 0
+        self.last = None
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+        self.last = value
+
+    def summary(self, now):
+        """Return the window summary and start a new window, or None if
+        nothing was reported since the last summary."""
+        if not self.count:
+            self.start = now
+            return None
+        window = now - self.start
+        ret = {'payload': self.total,
+               'count': self.count,
+               'rate': self.total / window if window > 0 else 0.0,
+               'window': window,
+               }
+        self.reset(now)
+        return ret
+
+
 class Application(object):
 
     """Information about a downstream API user."""
@@ -28,13 +63,17 @@ class Application(object):
                         'min_ask_i': {'done': 'stable', 'noop': 'noop'},
                         'noop': {}}
 
-    def __init__(self, uuid, container, progress, threads, phase_contexts):
+    def __init__(self, uuid, container, progress, threads, phase_contexts,
+                 now=0.0):
         self.uuid = uuid
         self.container_uuid = container
         self.progress = progress
         self.threads = threads
         self.thread_state = 'stable'
         self.phase_contexts = phase_contexts
+        self.performance = None
+        self.reports = {'progress': ReportWindow(now),
+                        'performance': ReportWindow(now)}
 
     def do_thread_transition(self, event):
         """Update the thread fsm state."""
@@ -67,10 +106,24 @@ class Application(object):
 
     def update_progress(self, msg):
         """Update the progress tracking."""
-        assert self.progress
+        self.progress += msg.payload
+        self.reports['progress'].add(msg.payload)
 
     def update_performance(self, msg):
-        """Update the progress tracking."""
+        """Update the performance tracking."""
+        self.performance = msg.payload
+        self.reports['performance'].add(msg.payload)
+
+    def summarize(self, now):
+        """Return a dictionary of the summaries of the progress and
+        performance reports since the last call, indexed by report type.
+        Types without reports are omitted."""
+        ret = dict()
+        for tag, window in self.reports.items():
+            summary = window.summary(now)
+            if summary:
+                ret[tag] = summary
+        return ret
 
     def update_phase_context(self, msg):
         """Update the phase contextual information."""
@@ -88,7 +141,7 @@ class ApplicationManager(object):
     def __init__(self):
         self.applications = dict()
 
-    def register(self, msg, container):
+    def register(self, msg, container, now=0.0):
         """Register a new downstream application."""
 
         uuid = msg['application_uuid']
@@ -105,7 +158,7 @@ class ApplicationManager(object):
         else:
             phase_contexts = None
         self.applications[uuid] = Application(uuid, container_uuid, progress,
-                                              threads, phase_contexts)
+                                              threads, phase_contexts, now)
 
     def delete(self, uuid):
         """Delete an application from the register."""
@@ -10,29 +10,117 @@
 
 from __future__ import print_function
 
-from aci import ImageManifest
-from yaml import load
+from aci import ImageManifest, ManifestCache
 from collections import namedtuple
+import heapq
+import itertools
 import logging
 from subprograms import ChrtClient, NodeOSClient, resources, SingularityClient
 import operator
+from telemetry import RingBuffer
+import time
+from tornado import gen, locks
+from tornado.concurrent import Future
+import uuid
 
 logger = logging.getLogger('nrm')
 Container = namedtuple('Container', ['uuid', 'manifest', 'resources',
                                      'power', 'processes', 'clientids',
                                      'hwbindings'])
+admission_policies = ['fifo', 'priority']
+
+
+class InstancePool(object):
+
+    """Runtime instances created ahead of the containers that will use them.
+
+    Instances are grouped by the key the runtime gives to a container (see
+    ContainerRuntime.pool_key): any instance of a group can stand in for a
+    new container of that group. Up to size instances per group are kept
+    ready, and replenished in the background once claimed."""
+
+    def __init__(self, runtime, size, downstream_uri):
+        self.runtime = runtime
+        self.size = size
+        self.downstream_uri = downstream_uri
+        self.ready = dict()
+        self.warming = dict()
+        self.warmups = set()
+        self.draining = False
+
+    def claim(self, key):
+        """Return the name of a ready instance of a group, or None."""
+        instances = self.ready.get(key)
+        if instances:
+            return instances.pop()
+        return None
+
+    def replenish(self, key, container):
+        """Start creating instances for the group of a container, until the
+        group is full."""
+        if self.draining:
+            return
+        warming = self.warming.setdefault(key, set())
+        missing = self.size - len(self.ready.get(key, [])) - len(warming)
+        for i in range(missing):
+            name = "nrm-pool-" + str(uuid.uuid4())
+            # counted right away, so that other launches see it
+            warming.add(name)
+            future = self._warm(key, container._replace(uuid=name))
+            self.warmups.add(future)
+            future.add_done_callback(self.warmups.discard)
+
+    @gen.coroutine
+    def _warm(self, key, container):
+        try:
+            yield self.runtime.create(container, self.downstream_uri)
+        except Exception as e:
+            logger.error("pool: could not create instance %s: %s",
+                         container.uuid, e)
+            return
+        finally:
+            self.warming[key].discard(container.uuid)
+        if self.draining:
+            # created after drain, delete it right away
+            yield self.runtime.delete(container.uuid, kill=True)
+            return
+        self.ready.setdefault(key, []).append(container.uuid)
+        logger.info("pool: instance %s ready", container.uuid)
+
+    def drain(self):
+        """Delete all the instances, the ready ones now and the ones being
+        created once they are. No instance is created afterwards.
+
+        Returns the futures of the deletes and of the instances being
+        created, resolved once they are deleted too."""
+        self.draining = True
+        futures = [self.runtime.delete(name, kill=True)
+                   for instances in self.ready.values() for name in instances]
+        futures.extend(self.warmups)
+        self.ready.clear()
+        return futures
 
 
 class ContainerManager(object):
 
     """Manages the creation, listing and deletion of containers, using a
-    container runtime underneath."""
+    container runtime underneath.
+
+    New containers whose slice does not fit in the free resources wait in
+    an admission queue, and are started when containers are deleted. The
+    queue is ordered by arrival (fifo) or by request priority first
+    (priority).
+
+    With a pool_size, new containers use runtime instances created in
+    advance when the runtime supports it (see InstancePool)."""
 
     def __init__(self, container_runtime, rm,
                  perfwrapper="nrm-perfwrapper",
                  linuxperf="perf",
                  pmpi_lib="/usr/lib/libnrm-pmpi.so",
-                 downstream_event_uri="ipc:///tmp/nrm-downstream-event"):
+                 downstream_event_uri="ipc:///tmp/nrm-downstream-event",
+                 max_launches=8, history_size=600, admission='fifo',
+                 manifest_cache_size=64, pool_size=0, max_teardowns=2):
         self.linuxperf = linuxperf
         self.perfwrapper = perfwrapper
         self.runtime = container_runtime
@@ -43,22 +131,42 @@ class ContainerManager(object):
         self.chrt = ChrtClient()
         self.pmpi_lib = pmpi_lib
         self.downstream_event_uri = downstream_event_uri
-
+        self.manifests = ManifestCache(ImageManifest, manifest_cache_size)
+        # runtime instances created in advance, and the ones in use
+        self.pool = None
+        if pool_size > 0:
+            self.pool = InstancePool(container_runtime, pool_size,
+                                     downstream_event_uri)
+        self.instances = dict()
+        # containers being created, and the number of launches in progress
+        self.pending = dict()
+        self.launches = locks.Semaphore(max_launches)
+        self.launch_latency = RingBuffer(history_size)
+        # teardowns share the runtime with launches, bound them too
+        self.teardowns = locks.Semaphore(max_teardowns)
+        # containers waiting for resources, as a heap of (key, request)
+        assert admission in admission_policies
+        self.admission = admission
+        self.queue = []
+        self.queued = dict()
+        self.arrivals = itertools.count()
+        self.queue_wait = RingBuffer(history_size)
+
+    @gen.coroutine
     def _get_container_tuple(self, container_name, manifest):
         """Retrieve a container tuple if the container exists, otherwise use
         the manifest to create a new one.
 
-        Returns (bool, container_tuple), the first field telling if a container
-        needs to be created."""
+        Resolves to (bool, container_tuple), the first field telling if a
+        container needs to be created."""
 
         if container_name in self.containers:
-            return (False, self.containers[container_name])
+            raise gen.Return((False, self.containers[container_name]))
 
-        # ask the resource manager for resources
+        # resources were allocated on admission
         ncpus = manifest.app['slice']['cpus']
-        nmems = manifest.app['slice']['mems']
-        req = resources(ncpus, nmems)
-        allocated = self.resourcemanager.schedule(container_name, req)
+        allocated = self.resourcemanager.allocations.get(container_name,
+                                                         resources([], []))
         logger.info("create: allocation: %r", allocated)
 
         # Container power settings
@@ -86,37 +194,172 @@ class ContainerManager(object):
             hwbindings['distrib'] = sorted(self.hwloc.distrib(
                                         ncpus, allocated), key=operator.
                                             attrgetter('cpus'))
-        return (True, Container(container_name, manifest, allocated,
-                                container_power, {}, {}, hwbindings))
+        raise gen.Return((True, Container(container_name, manifest, allocated,
+                                          container_power, {}, {},
+                                          hwbindings)))
+
+    @gen.coroutine
+    def _get_container(self, container_name, manifest):
+        """Retrieve a container, creating it if needed.
+
+        Requests for a container that is still being created wait for the
+        outcome of the first one, instead of creating it twice. Resources
+        allocated to a container are released if its creation fails."""
+        if container_name in self.pending:
+            container = yield self.pending[container_name]
+            if container is None:
+                raise RuntimeError("creation of container %s failed" %
+                                   container_name)
+            raise gen.Return(container)
+
+        pending = Future()
+        self.pending[container_name] = pending
+        try:
+            creation_needed, container = yield self._get_container_tuple(
+                    container_name, manifest)
+            if creation_needed:
+                yield self._start_instance(container)
+                self.containers[container_name] = container
+        except Exception:
+            if (container_name in self.resourcemanager.allocations and
+                    container_name not in self.containers):
+                self.resourcemanager.update(container_name)
+                self._admit_queued()
+            pending.set_result(None)
+            raise
+        else:
+            pending.set_result(container)
+        finally:
+            del self.pending[container_name]
+        raise gen.Return(container)
+
+    @gen.coroutine
+    def _start_instance(self, container):
+        """Create the runtime instance of a container, or claim one from
+        the pool."""
+        key = self.pool and self.runtime.pool_key(container)
+        name = key is not None and self.pool.claim(key)
+        if name:
+            logger.info("Using pooled instance %s for container %s", name,
+                        container.uuid)
+            self.instances[container.uuid] = name
+        else:
+            logger.info("Creating container %s", container.uuid)
+            yield self.runtime.create(container, self.downstream_event_uri)
+        if key is not None:
+            self.pool.replenish(key, container)
+
+    @gen.coroutine
+    def _admit(self, container_name, manifest, priority=0):
+        """Wait for the resources of a new container to be allocated.
+
+        Requests for containers that exist, or that are already admitted or
+        queued, go through."""
+        if (container_name in self.containers or
+                container_name in self.pending or
+                container_name in self.resourcemanager.allocations):
+            return
+        if container_name in self.queued:
+            yield self.queued[container_name][-1]
+            return
 
+        ncpus = manifest.app['slice']['cpus']
+        nmems = manifest.app['slice']['mems']
+        req = resources(ncpus, nmems)
+        node = self.resourcemanager.allresources
+        if ncpus > len(node.cpus) or nmems > len(node.mems):
+            raise ValueError("container %s asks for %d cpus and %d mems, "
+                             "more than the node has" %
+                             (container_name, ncpus, nmems))
+        if self.admission == 'priority':
+            key = (-priority, next(self.arrivals))
+        else:
+            key = (0, next(self.arrivals))
+        entry = (key, container_name, req,
+                 manifest.app['slice'].get('placement'), time.time(),
+                 Future())
+        heapq.heappush(self.queue, entry)
+        self.queued[container_name] = entry
+        self._admit_queued()
+        if not entry[-1].done():
+            logger.info("create: %s queued, %d waiting", container_name,
+                        len(self.queue))
+        yield entry[-1]
+
+    def _admit_queued(self):
+        """Allocate resources to the queued requests, in queue order, until
+        one does not fit."""
+        while self.queue:
+            key, name, req, placement, start, future = self.queue[0]
+            allocated = self.resourcemanager.schedule(name, req, placement)
+            if req.cpus and not allocated.cpus:
+                break
+            heapq.heappop(self.queue)
+            del self.queued[name]
+            now = time.time()
+            self.queue_wait.append(now, now - start)
+            future.set_result(allocated)
+
+    @gen.coroutine
     def create(self, request):
         """Create a container according to the request.
 
-        Returns the pid of the container or a negative number for errors."""
+        Resolves to the pid of the process and its container, once the
+        container runtime is done. New containers first wait for their
+        resources in the admission queue. Then at most max_launches requests
+        are processed at the same time, the others wait for their turn."""
+        start = time.time()
+        manifest = self._load_manifest(request['manifest'])
+        yield self._admit(request['uuid'], manifest,
+                          request.get('priority', 0))
+        with (yield self.launches.acquire()):
+            ret = yield self._create(request, manifest)
+        self.launch_latency.append(start, time.time() - start)
+        raise gen.Return(ret)
+
+    def queue_stats(self, now=None):
+        """Return the depth of the admission queue, the age of its oldest
+        request and percentiles of the recent waits, in seconds."""
+        now = now or time.time()
+        r = self.queue_wait
+        oldest = min([e[4] for e in self.queue] or [now])
+        return {'depth': len(self.queue),
+                'oldest': now - oldest,
+                'admitted': r.count,
+                'p50': r.percentile(50),
+                'max': r.max(),
+                }
+
+    def launch_stats(self):
+        """Return percentiles of the recent launch latencies, in seconds."""
+        r = self.launch_latency
+        return {'count': r.count,
+                'p50': r.percentile(50),
+                'p90': r.percentile(90),
+                'p99': r.percentile(99),
+                'max': r.max(),
+                }
+
+    def _load_manifest(self, manifestfile):
+        logger.info("create: manifest file:  %s", manifestfile)
+        try:
+            return self.manifests.load(manifestfile)
+        except Exception as e:
+            logger.error("error occured in manifest loading:")
+            raise(e)
+
+    @gen.coroutine
+    def _create(self, request, manifest):
 
-        manifestfile = request['manifest']
         command = request['file']
         args = request['args']
         environ = request['environ']
         container_name = request['uuid']
-        logger.info("create: manifest file:  %s", manifestfile)
         logger.info("create: command:        %s", command)
         logger.info("create: args:           %r", args)
         logger.info("create: container name: %s", container_name)
 
-        try:
-            with open(manifestfile) as f:
-                manifest = ImageManifest((load(f)))
-        except Exception as e:
-            logger.error("error occured in manifest loading:")
-            raise(e)
-
-        creation_needed, container = self._get_container_tuple(container_name,
-                                                               manifest)
-        if creation_needed:
-            logger.info("Creating container %s", container_name)
-            self.runtime.create(container, self.downstream_event_uri)
-            self.containers[container_name] = container
+        container = yield self._get_container(container_name, manifest)
 
         # build context to execute
         # environ['PATH'] = ("/usr/local/sbin:"
@@ -177,7 +420,9 @@ class ContainerManager(object):
         argv.extend(args)
 
         # run my command
-        process = self.runtime.execute(container_name, argv, environ)
+        process = self.runtime.execute(
+                self.instances.get(container_name, container_name), argv,
+                environ)
 
         # register the process
         container.processes[process.pid] = process
@@ -185,18 +430,44 @@ class ContainerManager(object):
         self.pids[process.pid] = container
         logger.info("Created process %s in container %s", process.pid,
                     container_name)
-        return process.pid, container
+        raise gen.Return((process.pid, container))
 
     def delete(self, uuid):
-        """Delete a container and kill all related processes."""
-        self.runtime.delete(uuid, kill=True)
+        """Delete a container and kill all related processes.
+
+        The container is forgotten right away, its teardown by the runtime
+        completes in the background, at most max_teardowns at a time.
+        Queued containers that fit in the freed resources are admitted.
+        Returns the teardown future."""
+        future = self._teardown(self.instances.pop(uuid, uuid))
         self.resourcemanager.update(uuid)
         c = self.containers[uuid]
         del self.containers[uuid]
         map(lambda i: self.pids.pop(c.processes[i].pid, None), c.processes)
+        self._admit_queued()
+        return future
+
+    @gen.coroutine
+    def _teardown(self, instance):
+        with (yield self.teardowns.acquire()):
+            yield self.runtime.delete(instance, kill=True)
 
     def kill(self, uuid):
-        """Kill all the processes of a container."""
+        """Kill all the processes of a container.
+
+        A container still waiting for admission is removed from the queue
+        instead, and its creation fails. Returns True in that case, as no
+        process exit will follow."""
+        if uuid in self.queued:
+            entry = self.queued.pop(uuid)
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            logger.info("kill: %s removed from the admission queue", uuid)
+            entry[-1].set_exception(
+                    RuntimeError("container %s killed while queued" % uuid))
+            # the next requests might fit now
+            self._admit_queued()
+            return True
         if uuid in self.containers:
             c = self.containers[uuid]
             logger.debug("killing %r:", c)
@@ -222,9 +493,17 @@ class ContainerRuntime(object):
 
     def create(self, container, downstream_uri):
         """Create the container defined by the container namedtuple on the
-        system."""
+        system.
+
+        Returns a future, resolved once the container exists."""
         raise NotImplementedError
 
+    def pool_key(self, container):
+        """Return what runtime instances created for the container depend
+        on, as a hashable key, or None if they can not be created in
+        advance."""
+        return None
+
     def execute(self, container_uuid, args, environ):
         """Execute a command inside a container, using a similar interface to
         popen.
@@ -233,14 +512,19 @@ class ContainerRuntime(object):
         raise NotImplementedError
 
     def delete(self, container_uuid, kill=False):
-        """Delete a container, possibly killing all the processes inside."""
+        """Delete a container, possibly killing all the processes inside.
+
+        Returns a future, resolved once the container is gone."""
         raise NotImplementedError
 
 
 class NodeOSRuntime(ContainerRuntime):
 
     """Implements the container runtime interface using the nodeos
-    subprogram."""
+    subprogram.
+
+    Containers are bound to their resources on creation, so they are never
+    created in advance."""
 
     def __init__(self, path="argo_nodeos_config"):
         """Creates the client for nodeos, with an optional custom
@@ -249,7 +533,7 @@ class NodeOSRuntime(ContainerRuntime):
 
     def create(self, container, downstream_uri):
         """Uses the container resource allocation to create a container."""
-        self.client.create(container.uuid, container.resources)
+        return self.client.create(container.uuid, container.resources)
 
     def execute(self, container_uuid, args, environ):
         """Launches a command in the container."""
@@ -257,7 +541,7 @@ class NodeOSRuntime(ContainerRuntime):
 
     def delete(self, container_uuid, kill=False):
         """Delete the container."""
-        self.client.delete(container_uuid, kill)
+        return self.client.delete(container_uuid, kill)
 
 
 class SingularityUserRuntime(ContainerRuntime):
@@ -273,8 +557,13 @@ class SingularityUserRuntime(ContainerRuntime):
     def create(self, container, downstream_uri):
         """Uses the container resource allocation to create a container."""
         imageinfo = container.manifest.image
-        self.client.instance_start(container.uuid, imageinfo['path'],
-                                   [downstream_uri]+imageinfo['binds'])
+        return self.client.instance_start(container.uuid, imageinfo['path'],
+                                          [downstream_uri]+imageinfo['binds'])
+
+    def pool_key(self, container):
+        """Instances only depend on the image and its bind mounts."""
+        imageinfo = container.manifest.image
+        return (imageinfo['path'], tuple(imageinfo['binds']))
 
     def execute(self, container_uuid, args, environ):
         """Launches a command in the container."""
@@ -282,7 +571,7 @@ class SingularityUserRuntime(ContainerRuntime):
 
     def delete(self, container_uuid, kill=False):
         """Delete the container."""
-        self.client.instance_stop(container_uuid, kill)
+        return self.client.instance_stop(container_uuid, kill)
 
 
 class DummyRuntime(ContainerRuntime):
@@ -293,8 +582,13 @@ class DummyRuntime(ContainerRuntime):
     def __init__(self):
         pass
 
+    def done(self):
+        future = Future()
+        future.set_result(None)
+        return future
+
     def create(self, container, downstream_uri):
-        pass
+        return self.done()
 
     def execute(self, container_uuid, args, environ):
         import tornado.process as process
@@ -304,4 +598,4 @@ class DummyRuntime(ContainerRuntime):
                                   env=environ)
 
     def delete(self, container_uuid, kill=False):
-        pass
+        return self.done()
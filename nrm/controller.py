@@ -11,6 +11,7 @@
 from __future__ import print_function
 
 import logging
+import re
 
 logger = logging.getLogger('nrm')
 
@@ -62,33 +63,193 @@ class Action(object):
 #        action.target.do_thread_transition(action.command)
 
 
+class ProportionalStepEngine(object):
+
+    """Moves a power cap by a step proportional to the power error.
+
+    The step is bounded by max_step watts, so that a large error does not
+    translate into a large jump of the cap."""
+
+    def __init__(self, gain=0.5, max_step=20.0):
+        self.gain = gain
+        self.max_step = max_step
+
+    def step(self, domain, error, dt):
+        """Return the cap change, in watts, for the given power error."""
+        return max(-self.max_step, min(self.max_step, self.gain * error))
+
+
+class PIDEngine(object):
+
+    """Moves a power cap according to a PID controller on the power error.
+
+    The controller is written in incremental (velocity) form: it computes
+    the change of the cap rather than the cap itself, which avoids integral
+    windup when the cap saturates at its limits. The integral gain is
+    expressed per second, so that the convergence speed doesn't depend on
+    the control period."""
+
+    def __init__(self, kp=0.2, ki=0.5, kd=0.0):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.errors = dict()
+
+    def step(self, domain, error, dt):
+        """Return the cap change, in watts, for the given power error."""
+        prev, prev2 = self.errors.get(domain, (error, error))
+        self.errors[domain] = (error, prev)
+        if not dt or dt <= 0:
+            return 0.0
+        return (self.kp * (error - prev) +
+                self.ki * dt * error +
+                self.kd * (error - 2 * prev + prev2) / dt)
+
+
+control_engines = {'step': ProportionalStepEngine,
+                   'pid': PIDEngine,
+                   }
+
+
+class BudgetAllocator(object):
+
+    """Splits a node power budget across RAPL domains.
+
+    When the budget covers the recent demand of all domains, each domain
+    gets its demand, and the surplus is shared in proportion to the headroom
+    left below each domain maximum. Domains drawing as much as their cap
+    allows (limited domains) likely need more than we measure: they get the
+    surplus first. Otherwise, the budget is shared in proportion to demand.
+    In both cases, shares stay within the [low, high] bounds of each domain,
+    and what a bounded domain cannot take is redistributed to the others."""
+
+    def waterfill(self, amount, weights, room):
+        """Distribute amount in proportion to weights, giving each key at
+        most room[key]."""
+        shares = {k: 0.0 for k in weights}
+        free = set(k for k in weights if room[k] > 0)
+        while amount > 1e-9 and free:
+            total = sum(weights[k] for k in free)
+            for k in free:
+                if total > 0:
+                    shares[k] += amount * weights[k] / total
+                else:
+                    shares[k] += amount / len(free)
+            amount = 0.0
+            for k in list(free):
+                if shares[k] >= room[k]:
+                    amount += shares[k] - room[k]
+                    shares[k] = room[k]
+                    free.remove(k)
+        return shares
+
+    def allocate(self, budget, demand, low, high, limited=()):
+        """Return the share of the budget of each domain.
+
+        demand, low and high are dictionaries indexed by domain, limited the
+        list of limited domains."""
+        base = {k: min(max(demand[k], low[k]), high[k]) for k in demand}
+        if budget >= sum(base.values()):
+            weights = {k: high[k] - base[k] for k in demand}
+            order = [{k: weights[k] for k in limited}, weights]
+        else:
+            base = dict(low)
+            order = [{k: max(demand[k] - low[k], 0.0) for k in demand}]
+        shares = dict(base)
+        amount = max(budget - sum(base.values()), 0.0)
+        for weights in order:
+            room = {k: high[k] - shares[k] for k in weights}
+            extra = self.waterfill(amount, weights, room)
+            for k in extra:
+                shares[k] += extra[k]
+            amount -= sum(extra.values())
+        return shares
+
+
 class PowerActuator(object):
 
-    """Actuator in charge of power control."""
+    """Actuator in charge of power control.
+
+    The node power target, minus the power of the domains we do not
+    control, is split across package (and optionally dram) domains by the
+    budget allocator, according to their recent demand. The engine then
+    turns the error between each domain target and its measured power into
+    a new cap for the domain."""
 
-    def __init__(self, sm):
+    def __init__(self, sm, engine=None, allocator=None, dram=False,
+                 window=3.0, min_cap=1.0, resolution=0.125, saturation=0.95):
         self.sensor_manager = sm
+        self.engine = engine or PIDEngine()
+        self.allocator = allocator or BudgetAllocator()
+        self.dram = dram
+        self.window = window
+        self.min_cap = min_cap
+        self.resolution = resolution
+        self.saturation = saturation
+        self.last_time = None
 
-    def available_actions(self, target):
-        actions = []
+    def controlled(self, domain):
+        """Tell if a RAPL domain is driven by this actuator."""
+        if self.dram and re.match('package-[0-9]+/dram$', domain):
+            return True
+        return re.match('package-[0-9]+$', domain) is not None
+
+    def demand(self, domain, measured):
+        """Recent mean power of a domain, from the sensor history."""
+        ring = self.sensor_manager.history.get('power', domain)
+        if ring is None:
+            return measured
+        return ring.mean(self.window)
+
+    def available_actions(self, target, machineinfo):
+        """Return the cap changes needed to move towards the target."""
+        t = machineinfo['time']
+        dt = t - self.last_time if self.last_time is not None else None
+        if dt is not None and dt <= 0:
+            # no new measurement since last time
+            return []
+        self.last_time = t
+
+        power = machineinfo['energy']['power']
         pl = self.sensor_manager.get_powerlimits()
-        logger.info("power limits: %r:", pl)
-        if target == 'i':
-            for k in pl:
-                r = range(int(pl[k]['curW'])+1, int(pl[k]['maxW']))
-                actions.extend([Action(k, s, s - r[0]) for s in r])
-        elif target == 'd':
-            for k in pl:
-                r = range(1, int(pl[k]['curW']))
-                actions.extend([Action(k, s, r[-1] - s) for s in r])
+        logger.debug("power limits: %r:", pl)
+        domains = [k for k in pl if self.controlled(k)]
+        if not domains:
+            return []
+        # power readings use short domain names: package-0 -> p0
+        short = {k: k.replace('package-', 'p') for k in domains}
+        measured = {k: power[short[k]] for k in domains}
+        budget = target - (power['total'] - sum(measured.values()))
+        demand = {k: self.demand(short[k], measured[k]) for k in domains}
+        low = {k: self.min_cap for k in domains}
+        # unreadable maximums don't bound anything
+        high = {k: pl[k]['maxW'] if pl[k]['maxW'] > 0 else max(budget, 0.0)
+                for k in domains}
+        limited = [k for k in domains
+                   if measured[k] >= self.saturation * pl[k]['curW']]
+        shares = self.allocator.allocate(budget, demand, low, high, limited)
+        logger.debug("power budget shares: %r", shares)
+
+        actions = []
+        for k in domains:
+            cur = pl[k]['curW']
+            cap = cur + self.engine.step(k, shares[k] - measured[k], dt)
+            cap = max(min(cap, high[k]), low[k])
+            # ignore changes below the cap resolution, unless they bring us
+            # to one of the bounds.
+            if abs(cap - cur) >= self.resolution or \
+                    (cap in (low[k], high[k]) and cap != cur):
+                actions.append(Action(k, cap, cap - cur))
         return actions
 
-    def execute(self, action):
-        logger.info("changing power limit: %r, %r", action.command,
-                    action.delta)
-        self.sensor_manager.set_powerlimit(action.target, action.command)
+    def execute(self, actions):
+        """Apply all the cap changes of a control tick at once."""
+        logger.info("changing power limits: %r",
+                    [(a.target, a.command, a.delta) for a in actions])
+        self.sensor_manager.set_powerlimits(
+                {a.target: a.command for a in actions})
 
-    def update(self, action):
+    def update(self, actions):
         pass
 
 
@@ -100,39 +261,40 @@ class Controller(object):
         self.actuators = actuators
 
     def planify(self, target, machineinfo):
-        """Plan the next action for the control loop."""
+        """Plan the next actions for the control loop.
+
+        Returns a list of (action, actuator) pairs."""
         try:
-            total_power = machineinfo['energy']['power']['total']
+            machineinfo['energy']['power']['total']
         except TypeError:
             logging.error("\"machineinfo\" malformed. Can not run "
                           "control loop.")
-            return (None, None)
-
-        direction = None
-        if total_power < target:
-            direction = 'i'
-        elif total_power > target:
-            direction = 'd'
-
-        if direction:
-            actions = []
-            for act in self.actuators:
-                newactions = act.available_actions(direction)
-                actions.extend([(a, act) for a in newactions])
+            return []
+
+        actions = []
+        for act in self.actuators:
+            newactions = act.available_actions(target, machineinfo)
+            actions.extend([(a, act) for a in newactions])
+        return actions
+
+    def batches(self, plan):
+        """Group the actions of a plan by actuator."""
+        ret = []
+        for act in self.actuators:
+            actions = [a for a, actuator in plan if actuator is act]
             if actions:
-                # TODO: better choice
-                actions.sort(key=lambda x: x[0].delta)
-                return actions.pop(0)
-            else:
-                return (None, None)
+                ret.append((act, actions))
+        return ret
 
-    def execute(self, action, actuator):
-        """Build the action for the appropriate manager."""
-        actuator.execute(action)
+    def execute(self, plan):
+        """Apply a plan, with one batch of actions per actuator."""
+        for actuator, actions in self.batches(plan):
+            actuator.execute(actions)
 
-    def update(self, action, actuator):
-        """Update tracking across the board to reflect the last action."""
-        actuator.update(action)
+    def update(self, plan):
+        """Update tracking across the board to reflect the last plan."""
+        for actuator, actions in self.batches(plan):
+            actuator.update(actions)
 
     def run_policy_container(self, container, application):
         """Run policies on a container."""
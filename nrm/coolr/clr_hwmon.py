@@ -20,6 +20,7 @@
 import re, os, sys
 import numpy as np
 from clr_nodeinfo import *
+import clr_sysfs
 
 class coretemp_reader :
     def parse_pkgtemp(self,fn):
@@ -58,6 +59,8 @@ class coretemp_reader :
 
     def __init__ (self):
         self.outputpercore(True)
+        # temperature inputs are kept open and re-read in place
+        self.sysfs = clr_sysfs.sysfs_reader()
 
         self.coretemp = {} # use pkgid as  key
         for d1 in os.listdir(self.hwmondir):
@@ -90,23 +93,36 @@ class coretemp_reader :
             cti.dir = tmpdir
             cti.coretempfns = coretempfns
             cti.pkgtempfn = pkgtempfn
+            for fn in [pkgtempfn] + coretempfns.values():
+                if os.access(fn, os.R_OK):
+                    self.sysfs.register(fn)
 
             if pkgid < 0: # assume a single socket machine
                 self.coretemp[0] = cti
             else:
                 self.coretemp[pkgid] = cti
 
+    # read a registered temperature input, in degree Celsius. Returns
+    # None if the sensor is gone (e.g., its cpu went offline).
+    def readtemp(self, fn):
+        if not self.sysfs.registered(fn):
+            return None
+        try:
+            return self.sysfs.readint(fn)/1000
+        except (IOError, OSError, ValueError):
+            return None
+
     def readtempall(self):
         ctemp = self.coretemp
         ret = {}
         for pkgid in sorted(ctemp.keys()):
             temps = {}
-            if os.access(ctemp[pkgid].pkgtempfn, os.R_OK):
-                val = int(readbuf(ctemp[pkgid].pkgtempfn))/1000
+            val = self.readtemp(ctemp[pkgid].pkgtempfn)
+            if val is not None:
                 temps['pkg'] = val
             for c in sorted(ctemp[pkgid].coretempfns.keys()):
-                if os.access(ctemp[pkgid].coretempfns[c], os.R_OK):
-                    val = int(readbuf(ctemp[pkgid].coretempfns[c]))/1000
+                val = self.readtemp(ctemp[pkgid].coretempfns[c])
+                if val is not None:
                     temps[c] = val
             ret[pkgid] = temps
         return ret
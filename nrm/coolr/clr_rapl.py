@@ -20,6 +20,7 @@
 import os, sys, re, time, getopt
 
 import clr_nodeinfo
+import clr_sysfs
 
 class rapl_reader:
     dryrun = False
@@ -28,16 +29,28 @@ class rapl_reader:
 
     re_domain = re.compile('package-([0-9]+)(/\S+)?')
 
+    # attributes re-read on every sample or power limit query. They
+    # are opened once at discovery time and kept open afterwards.
+    sampled_attrs = ['energy_uj', 'constraint_0_power_limit_uw',
+                     'constraint_0_max_power_uw', 'enabled']
+
+    # read an integer from a sysfs attribute, through the persistent
+    # descriptors of the sysfs reader. IOError and ValueError are
+    # propagated to the caller.
     def readint(self, fn):
-        v = -1
-        for retry in range(0,10):
-            try:
-                f = open( fn )
-                v = int(f.readline())
-                f.close()
-            except:
-                continue
-        return v
+        if not self.sysfs.registered(fn):
+            self.sysfs.register(fn)
+        return self.sysfs.readint(fn)
+
+    # same as readint, but failures are recorded in read_errors and
+    # the default value is returned instead. Some attributes (e.g.,
+    # max_power_uw on dram domains) exist but always fail to read.
+    def readint_default(self, fn, default=-1):
+        try:
+            return self.readint(fn)
+        except (IOError, OSError, ValueError) as e:
+            self.read_errors[fn] = e
+            return default
 
     def writeint(self, fn, v):
         ret = False
@@ -54,9 +67,18 @@ class rapl_reader:
     # intel-rapl:0/name
     # intel-rapl:0/intel-rapl:0:0/name
     # intel-rapl:0/intel-rapl:0:1/name
-    def __init__ (self):
+    #
+    # powerlimit_period is the maximum age in seconds of the cached
+    # power limits before they are read again from sysfs. None means
+    # the cache is only refreshed after a power limit is written.
+    def __init__ (self, powerlimit_period=10.0):
         self.dirs = {}
+        self.powerlimit_period = powerlimit_period
+        self.powerlimits = None
+        self.powerlimits_time = 0.0
         self.max_energy_range_uj_d = {}
+        self.sysfs = clr_sysfs.sysfs_reader()
+        self.read_errors = {}
 
         if self.dryrun :
             return 
@@ -96,12 +118,22 @@ class rapl_reader:
                 sys.exit(0)
             self.max_energy_range_uj_d[k] = int(f.readline())
             f.close()
+            for a in self.sampled_attrs:
+                fn = "%s/%s" % (self.dirs[k], a)
+                if os.path.exists(fn):
+                    try:
+                        self.sysfs.register(fn)
+                    except (IOError, OSError) as e:
+                        self.read_errors[fn] = e
 
         self.start_energy_counter()
 
     def initialized(self):
         return self.init
 
+    def close(self):
+        self.sysfs.close()
+
     def shortenkey(self,str):
         return str.replace('package-','p')
 
@@ -120,7 +152,7 @@ class rapl_reader:
             return ret
         for k in sorted(self.dirs.keys()):
             fn = self.dirs[k] + "/energy_uj"
-            ret[k] = self.readint(fn)
+            ret[k] = self.readint_default(fn)
         return ret
 
     # Read all possible power caps, except package 'short_term', which
@@ -139,14 +171,14 @@ class rapl_reader:
             return ret
         for k in sorted(self.dirs.keys()):
             dvals = {}
-            v = self.readint( self.dirs[k] + '/constraint_0_power_limit_uw' )
+            v = self.readint_default( self.dirs[k] + '/constraint_0_power_limit_uw' )
             dvals['curW'] = v * 1e-6  # uw to w
 
-            v = self.readint( self.dirs[k] + '/constraint_0_max_power_uw' )
+            v = self.readint_default( self.dirs[k] + '/constraint_0_max_power_uw' )
             dvals['maxW'] = v * 1e-6  # uw to w
 
             dvals['enabled'] = False
-            v = self.readint( self.dirs[k] + '/enabled' )
+            v = self.readint_default( self.dirs[k] + '/enabled' )
             if v == 1:
                 dvals['enabled'] = True
             ret[k] = dvals
@@ -257,7 +289,7 @@ class rapl_reader:
         ret['power']['total'] = totalpower
 
         ret['powercap'] = dict()
-        rlimit = self.readpowerlimitall()
+        rlimit = self.get_powerlimits()
         for k in sorted(rlimit.keys()):
             ret['powercap'][self.shortenkey(k)] = rlimit[k]['curW']
 
@@ -298,27 +330,57 @@ class rapl_reader:
     def get_powerdomains(self):
         return self.readpowerlimitall().keys
 
-    def get_powerlimits(self):
-        return self.readpowerlimitall()
+    # Cached version of readpowerlimitall. The cache is refreshed
+    # when refresh is set, after a failed power limit write, or when
+    # it is older than powerlimit_period. Successful writes update it
+    # in place.
+    def get_powerlimits(self, refresh=False):
+        now = time.time()
+        if self.powerlimits is None or refresh or \
+                (self.powerlimit_period is not None and
+                 now - self.powerlimits_time >= self.powerlimit_period):
+            self.powerlimits = self.readpowerlimitall()
+            self.powerlimits_time = now
+        return self.powerlimits
+
+    def invalidate_powerlimits(self):
+        self.powerlimits = None
+
+    # record a written long term limit in the cache. The cached
+    # domain dicts are replaced, not modified, as callers may still
+    # hold the previous ones. Should the kernel clamp the value, the
+    # next periodic refresh picks up the actual limit.
+    def update_powerlimit(self, rrdir, curW):
+        if self.powerlimits is None:
+            return
+        for k in self.dirs:
+            if self.dirs[k] == rrdir and k in self.powerlimits:
+                self.powerlimits[k] = dict(self.powerlimits[k], curW=curW)
 
     def _set_powerlimit(self, rrdir, newval, id = 0):
         fn = rrdir + '/constraint_%d_power_limit_uw' % id
-        uw = newval * 1e6
+        uw = int(newval * 1e6)
         try:
             f = open(fn, 'w')
         except:
             print 'Failed to update:', fn, '(root privilege is required)'
             return
-        f.write('%d' % uw)
-        f.close()
+        try:
+            f.write('%d' % uw)
+            f.close()
+        except (IOError, OSError):
+            print 'Failed to update:', fn
+            self.invalidate_powerlimits()
+            return
+        if id == 0:
+            self.update_powerlimit(rrdir, uw * 1e-6)
 
     def set_powerlimit(self, newval, dom):
         l = self.dirs[dom]
         self._set_powerlimit(l, newval)
 
     def set_powerlimit_pkg(self, newval):
-        rlims = self.readpowerlimitall()
-        for k in rlims.keys():
+        for k in self.dirs.keys():
             if re.findall('package-[0-9]$', k):
                 self._set_powerlimit(self.dirs[k], newval)
 
@@ -0,0 +1,65 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+#!/usr/bin/env python
+#
+# coolr sysfs attribute reader
+#
+# sysfs attributes regenerate their content on every read from offset
+# zero, so an attribute file can be opened once and re-read by seeking
+# back to the start. This avoids the open/read/close cycle (and the
+# associated path lookups) on every sample.
+#
+
+import errno, io
+
+class sysfs_reader:
+    # sysfs attributes are at most a page, but the numerical ones we
+    # care about fit in a couple dozen bytes.
+    bufsize = 64
+
+    def __init__(self):
+        self.files = {}
+        self.buf = bytearray(self.bufsize)
+
+    # open an attribute once and keep its descriptor around. Raises
+    # IOError if the file cannot be opened.
+    def register(self, fn):
+        if fn not in self.files:
+            self.files[fn] = io.FileIO(fn, 'r')
+        return fn
+
+    def registered(self, fn):
+        return fn in self.files
+
+    # re-read a registered attribute into the preallocated buffer.
+    # Raises IOError on read errors, empty or truncated reads.
+    def read(self, fn):
+        f = self.files[fn]
+        f.seek(0)
+        n = f.readinto(self.buf)
+        if not n:
+            raise IOError(errno.ENODATA, 'empty sysfs read', fn)
+        if n == self.bufsize:
+            raise IOError(errno.EOVERFLOW, 'sysfs value too large', fn)
+        return self.buf[:n]
+
+    # Raises ValueError if the attribute is not an integer.
+    def readint(self, fn):
+        return int(self.read(fn))
+
+    def unregister(self, fn):
+        f = self.files.pop(fn, None)
+        if f is not None:
+            f.close()
+
+    def close(self):
+        for fn in self.files.keys():
+            self.unregister(fn)
@@ -12,49 +12,90 @@ from __future__ import print_function
 
 from applications import ApplicationManager
 from containers import ContainerManager, NodeOSRuntime, SingularityUserRuntime
-from controller import Controller, PowerActuator
+from controller import Controller, PowerActuator, control_engines
+from datetime import timedelta
 from powerpolicy import PowerPolicyManager
 from functools import partial
 import logging
+import logs
 import os
+from output import OutputForwarder, SpoolFile, spool_path
+from reaper import Reaper
 from resources import ResourceManager
-from sensor import SensorManager
+from sensor import SensorManager, SensorSampler
 import signal
+from telemetry import TelemetryStore
+import time
+from tornado import gen
 from zmq.eventloop import ioloop
 from nrm.messaging import UpstreamRPCServer, UpstreamPubServer, \
         DownstreamEventServer
 
 logger = logging.getLogger('nrm')
+# categories of the logs of the hot paths, see logs.hot_categories
+events_logger = logging.getLogger('nrm.events')
+sensor_logger = logging.getLogger('nrm.sensor')
+output_logger = logging.getLogger('nrm.output')
 
 
 class Daemon(object):
 
+    # longest time in seconds the shutdown waits for the pool to drain
+    shutdown_timeout = 10.0
+
     def __init__(self, config):
         self.target = 100.0
         self.config = config
+        # achieved periods of the sensor and control callbacks
+        self.periods = TelemetryStore(config.history_size)
+        self.ticks = dict()
+        self.launches = 0
+        self.queue_depth = 0
+
+    def track_period(self, name):
+        """Record the time elapsed since the last call for this name."""
+        now = time.time()
+        last = self.ticks.get(name)
+        if last is not None:
+            self.periods.append(name, now, now - last)
+        self.ticks[name] = now
+
+    def period_stats(self):
+        """Return the mean and max of the recent achieved periods of the
+        periodic callbacks, in seconds."""
+        return {name: {'mean': ring.mean(), 'max': ring.max()}
+                for name, ring in self.periods.series.items()}
 
     def do_downstream_receive(self, event, client):
-        logger.info("receiving downstream message: %r", event)
+        events_logger.debug("receiving downstream message: %r", event)
+        if event.tag == 'batch':
+            for e in event.events:
+                self.do_downstream_event(e, client)
+        else:
+            self.do_downstream_event(event, client)
+
+    def do_downstream_event(self, event, client):
         if event.tag == 'start':
             cid = event.container_uuid
             container = self.container_manager.containers[cid]
-            self.application_manager.register(event, container)
+            self.application_manager.register(event, container, time.time())
         elif event.tag == 'progress':
             if event.application_uuid in self.application_manager.applications:
                 app = self.application_manager.applications[
                         event.application_uuid]
-                app.update_performance(event)
-                # self.upstream_pub_server.send(event) TODO try this.
-                self.upstream_pub_server.send(
-                        tag='progress',
-                        payload=event.payload,
-                        application_uuid=event.application_uuid)
+                app.update_progress(event)
+                if self.config.report_raw:
+                    self.upstream_pub_server.send(
+                            tag='progress',
+                            payload=event.payload,
+                            application_uuid=event.application_uuid)
         elif event.tag == 'performance':
             if event.application_uuid in self.application_manager.applications:
                 app = self.application_manager.applications[
                         event.application_uuid]
                 app.update_performance(event)
-            self.upstream_pub_server.send(
+            if self.config.report_raw:
+                self.upstream_pub_server.send(
                         tag='performance',
                         payload=event.payload,
                         container_uuid=event.container_uuid)
@@ -72,11 +113,14 @@ class Daemon(object):
         elif event.tag == 'exit':
             uuid = event.application_uuid
             if uuid in self.application_manager.applications:
+                app = self.application_manager.applications[uuid]
+                self.do_report_application(app, time.time())
                 self.application_manager.delete(uuid)
         else:
             logger.error("unknown msg: %r", event)
             return
 
+    @gen.coroutine
     def do_upstream_receive(self, req, client):
         if req.tag == 'setPower':
             self.target = float(req.limit)
@@ -94,8 +138,19 @@ class Daemon(object):
                       'uuid': req.container_uuid,
                       'environ': req.environ,
                       'clientid': client,
+                      'priority': req.get('priority', 0),
                       }
-            pid, container = self.container_manager.create(params)
+            try:
+                pid, container = yield self.container_manager.create(params)
+            except Exception as e:
+                logger.exception("could not run in container %s",
+                                 container_uuid)
+                self.upstream_rpc_server.send(
+                        client,
+                        tag='error',
+                        container_uuid=container_uuid,
+                        message=str(e))
+                return
             container_uuid = container.uuid
             if len(container.processes) == 1:
                 if container.power['policy']:
@@ -106,7 +161,7 @@ class Daemon(object):
                             float(container.power['slowdown']))
                 if container.power['profile']:
                     p = container.power['profile']
-                    p['start'] = self.machine_info['energy']['energy']
+                    p['start'] = dict(self.machine_info['energy']['energy'])
                     p['start']['time'] = self.machine_info['time']
                 self.upstream_pub_server.send(
                         tag='start',
@@ -119,41 +174,76 @@ class Daemon(object):
                     tag='start',
                     pid=pid,
                     container_uuid=container_uuid)
-            # setup io callbacks
-            outcb = partial(self.do_children_io, client, container_uuid,
-                            'stdout')
-            errcb = partial(self.do_children_io, client, container_uuid,
-                            'stderr')
-            container.processes[pid].stdout.read_until_close(outcb, outcb)
-            container.processes[pid].stderr.read_until_close(errcb, errcb)
+            # setup io forwarding
+            for io in ['stdout', 'stderr']:
+                self.forward_children_io(client, container_uuid, io,
+                                         getattr(container.processes[pid],
+                                                 io))
         elif req.tag == 'kill':
             logger.info("asked to kill container: %r", req)
             response = self.container_manager.kill(req.container_uuid)
-            # no update here, as it will trigger child exit
+            if response:
+                # never started, no child exit will answer
+                self.upstream_rpc_server.send(
+                        client,
+                        tag='exit',
+                        container_uuid=req.container_uuid,
+                        status=str(signal.SIGTERM))
+            # otherwise no update here, as it will trigger child exit
         elif req.tag == 'list':
             logger.info("asked for container list: %r", req)
             response = self.container_manager.list()
             self.upstream_rpc_server.send(
                     client,
                     tag="list",
-                    payload=response)
+                    containers=[c['uuid'] for c in response],
+                    resources=self.resource_manager.report())
         else:
             logger.error("invalid command: %r", req.tag)
 
+    def forward_children_io(self, client, container_uuid, io, stream):
+        """Forward the output of a child to the client, or to a spool file
+        if the daemon is configured with one."""
+        write = partial(self.do_children_io, client, container_uuid, io)
+        done = partial(write, None)
+        if self.config.output_spool:
+            path = spool_path(self.config.output_spool, container_uuid, io)
+            logger.info("%r %s spooled to %s", container_uuid, io, path)
+            spool = SpoolFile(path)
+            write = spool.write
+
+            @gen.coroutine
+            def done():
+                yield spool.close()
+                self.do_children_io(client, container_uuid, io, None)
+        OutputForwarder(stream, write, done,
+                        max_size=self.config.output_batch_size,
+                        max_delay=self.config.output_delay / 1000.0).start()
+
     def do_children_io(self, client, container_uuid, io, data):
         """Receive data from one of the children, and send it down the pipe.
 
-        Meant to be partially defined on a children basis."""
-        logger.info("%r received %r data: %r", container_uuid, io, data)
+        Meant to be partially defined on a children basis. Returns a future
+        resolved once the message is queued in ZMQ."""
+        output_logger.debug("%r received %r data: %r", container_uuid, io,
+                            data)
         self.upstream_rpc_server.send(
                 client,
                 tag=io,
                 container_uuid=container_uuid,
                 payload=data or 'eof')
+        return self.upstream_rpc_server.drained(client)
 
     def do_sensor(self):
-        self.machine_info = self.sensor_manager.do_update()
-        logger.info("current state: %r", self.machine_info)
+        self.track_period('sensor')
+        if self.sensor_sampler:
+            # only pick up the latest snapshot, never wait on the sensors.
+            snapshot = self.sensor_sampler.snapshot
+            if snapshot:
+                self.machine_info = snapshot
+        else:
+            self.machine_info = self.sensor_manager.do_update()
+        sensor_logger.debug("current state: %r", self.machine_info)
         try:
             total_power = self.machine_info['energy']['power']['total']
         except TypeError:
@@ -165,12 +255,41 @@ class Daemon(object):
                     total=total_power,
                     limit=self.target)
 
+    def do_report_application(self, app, now):
+        """Publish the summaries of the reports of an application."""
+        for tag, summary in app.summarize(now).items():
+            self.upstream_pub_server.send(
+                    tag=tag,
+                    application_uuid=app.uuid,
+                    container_uuid=app.container_uuid,
+                    **summary)
+
+    def do_report(self):
+        self.track_period('report')
+        now = time.time()
+        for app in self.application_manager.applications.values():
+            self.do_report_application(app, now)
+        stats = self.container_manager.launch_stats()
+        if stats['count'] != self.launches:
+            self.launches = stats['count']
+            logger.info("container launch latency: %r", stats)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("achieved periods: %r", self.period_stats())
+        queue = self.container_manager.queue_stats(now)
+        if queue['depth'] or self.queue_depth:
+            self.queue_depth = queue['depth']
+            self.upstream_pub_server.send(
+                    tag='queue',
+                    depth=queue['depth'],
+                    oldest=queue['oldest'],
+                    wait=queue['p50'] or 0.0)
+
     def do_control(self):
+        self.track_period('control')
         plan = self.controller.planify(self.target, self.machine_info)
-        action, actuator = plan
-        if action:
-            self.controller.execute(action, actuator)
-            self.controller.update(action, actuator)
+        if plan:
+            self.controller.execute(plan)
+            self.controller.update(plan)
         # Call policy only if there are containers
         # if self.container_manager.containers:
             # self.controller.run_policy(self.container_manager.containers)
@@ -179,76 +298,94 @@ class Daemon(object):
         if signum == signal.SIGINT:
             ioloop.IOLoop.current().add_callback_from_signal(self.do_shutdown)
         elif signum == signal.SIGCHLD:
-            ioloop.IOLoop.current().add_callback_from_signal(self.do_children)
+            self.reaper.signal()
         else:
             logger.error("wrong signal: %d", signum)
 
-    def do_children(self):
-        # find out if children have terminated
-        while True:
-            try:
-                pid, status, rusage = os.wait3(os.WNOHANG)
-                if pid == 0 and status == 0:
-                    break
-            except OSError:
-                break
+    def do_children(self, batch):
+        """Handle a batch of child updates from the reaper.
 
+        Containers left without processes are deleted, their teardown by
+        the runtime goes on in the background. A failure on one child does
+        not prevent handling the others."""
+        for pid, status, rusage in batch:
             logger.info("child update %d: %r", pid, status)
             # check if its a pid we care about
-            if pid in self.container_manager.pids:
-                # check if this is an exit
-                if os.WIFEXITED(status) or os.WIFSIGNALED(status):
-                    container = self.container_manager.pids[pid]
-                    clientid = container.clientids[pid]
-
-                    # first, send a process_exit
-                    self.upstream_rpc_server.send(
-                            clientid,
-                            tag="exit",
-                            status=str(status),
-                            container_uuid=container.uuid)
-                    # Remove the pid of process that is finished
-                    container.processes.pop(pid, None)
-                    self.container_manager.pids.pop(pid, None)
-                    logger.info("Process %s in Container %s has finished.",
-                                pid, container.uuid)
-
-                    # if this is the last process in the container,
-                    # kill everything
-                    if len(container.processes) == 0:
-                        # deal with container exit
-                        diff = {}
-                        p = container.power
-                        if p['policy']:
-                            p['manager'].reset_all()
-                        if p['profile']:
-                            e = p['profile']['end']
-                            self.machine_info = self.sensor_manager.do_update()
-                            e = self.machine_info['energy']['energy']
-                            e['time'] = self.machine_info['time']
-                            s = p['profile']['start']
-                            # Calculate difference between the values
-                            diff = self.sensor_manager.calc_difference(s, e)
-                            # Get final package temperature
-                            temp = self.machine_info['temperature']
-                            diff['temp'] = map(lambda k: temp[k]['pkg'], temp)
-                            diff['policy'] = p['policy']
-                            if p['policy']:
-                                diff['damper'] = float(p['damper'])/1000000000
-                                diff['slowdown'] = p['slowdown']
-                            diff['nodename'] = self.sensor_manager.nodename
-                            logger.info("Container %r profile data: %r",
-                                        container.uuid, diff)
-                        self.container_manager.delete(container.uuid)
-                        self.upstream_pub_server.send(
-                                tag="exit",
-                                container_uuid=container.uuid,
-                                profile_data=diff)
-            else:
+            if pid not in self.container_manager.pids:
                 logger.debug("child update ignored")
-                pass
+                continue
+            # check if this is an exit
+            if os.WIFEXITED(status) or os.WIFSIGNALED(status):
+                try:
+                    self.do_child_exit(pid, status)
+                except Exception:
+                    logger.exception("could not handle exit of child %d",
+                                     pid)
+
+    def do_child_exit(self, pid, status):
+        container = self.container_manager.pids[pid]
+        clientid = container.clientids[pid]
+
+        # first, send a process_exit
+        self.upstream_rpc_server.send(
+                clientid,
+                tag="exit",
+                status=str(status),
+                container_uuid=container.uuid)
+        # Remove the pid of process that is finished
+        container.processes.pop(pid, None)
+        self.container_manager.pids.pop(pid, None)
+        logger.info("Process %s in Container %s has finished.",
+                    pid, container.uuid)
+
+        # if this is the last process in the container,
+        # kill everything
+        if len(container.processes) == 0:
+            # deal with container exit
+            diff = {}
+            p = container.power
+            if p['policy']:
+                p['manager'].reset_all()
+            if p['profile']:
+                s = p['profile']['start']
+                # use the latest sample, sensors are updated periodically
+                # anyway, unless it was taken before the container started
+                if self.machine_info['time'] <= s['time']:
+                    self.machine_info = self.sensor_manager.do_update()
+                e = dict(self.machine_info['energy']['energy'])
+                e['time'] = self.machine_info['time']
+                # Calculate difference between the values
+                diff = self.sensor_manager.calc_difference(s, e)
+                # Get final package temperature
+                temp = self.machine_info['temperature']
+                diff['temp'] = map(lambda k: temp[k]['pkg'], temp)
+                diff['policy'] = p['policy']
+                if p['policy']:
+                    diff['damper'] = float(p['damper'])/1000000000
+                    diff['slowdown'] = p['slowdown']
+                diff['nodename'] = self.sensor_manager.nodename
+                logger.info("Container %r profile data: %r",
+                            container.uuid, diff)
+            self.container_manager.delete(container.uuid)
+            self.upstream_pub_server.send(
+                    tag="exit",
+                    container_uuid=container.uuid,
+                    profile_data=diff)
 
+    @gen.coroutine
     def do_shutdown(self):
+        if self.container_manager.pool:
+            try:
+                yield gen.with_timeout(
+                        timedelta(seconds=self.shutdown_timeout),
+                        gen.multi(self.container_manager.pool.drain()))
+            except gen.TimeoutError:
+                logger.warning("pool instances still up after %g seconds",
+                               self.shutdown_timeout)
+            except Exception:
+                logger.exception("could not drain the instance pool")
+        if self.sensor_sampler:
+            self.sensor_sampler.stop()
         self.sensor_manager.stop()
         ioloop.IOLoop.current().stop()
 
@@ -266,9 +403,12 @@ class Daemon(object):
         upstream_pub_param = "tcp://%s:%d" % (bind_address, upstream_pub_port)
         upstream_rpc_param = "tcp://%s:%d" % (bind_address, upstream_rpc_port)
 
-        self.downstream_event = DownstreamEventServer(downstream_event_param)
+        self.downstream_event = DownstreamEventServer(
+                downstream_event_param,
+                validate=not self.config.trust_downstream)
         self.upstream_pub_server = UpstreamPubServer(upstream_pub_param)
-        self.upstream_rpc_server = UpstreamRPCServer(upstream_rpc_param)
+        self.upstream_rpc_server = UpstreamRPCServer(
+                upstream_rpc_param, hwm=self.config.rpc_hwm)
 
         logger.info("downstream event socket bound to: %s",
                     downstream_event_param)
@@ -280,7 +420,9 @@ class Daemon(object):
         self.upstream_rpc_server.setup_recv_callback(self.do_upstream_receive)
 
         # create managers
-        self.resource_manager = ResourceManager(hwloc=self.config.hwloc)
+        self.resource_manager = ResourceManager(
+                hwloc=self.config.hwloc,
+                placement=self.config.placement)
         container_runtime = None
         if self.config.container_runtime == 'nodeos':
             container_runtime = \
@@ -296,23 +438,48 @@ class Daemon(object):
                 linuxperf=self.config.perf,
                 pmpi_lib=self.config.pmpi_lib,
                 downstream_event_uri=downstream_event_param,
+                max_launches=self.config.max_launches,
+                history_size=self.config.history_size,
+                admission=self.config.admission,
+                pool_size=self.config.pool_size,
+                max_teardowns=self.config.max_teardowns,
         )
         self.application_manager = ApplicationManager()
-        self.sensor_manager = SensorManager()
-        pa = PowerActuator(self.sensor_manager)
+        self.sensor_manager = SensorManager(
+                powerlimit_period=self.config.powerlimit_period,
+                history_size=self.config.history_size)
+        engine = control_engines[self.config.control_engine]()
+        pa = PowerActuator(self.sensor_manager, engine,
+                           dram=self.config.control_dram)
         self.controller = Controller([pa])
 
         self.sensor_manager.start()
         self.machine_info = self.sensor_manager.do_update()
 
+        # optionally move sensor reads out of the ioloop
+        self.sensor_sampler = None
+        if self.config.sensor_thread:
+            self.sensor_sampler = SensorSampler(
+                    self.sensor_manager, self.config.sensor_period / 1000.0)
+            self.sensor_sampler.start()
+
         # setup periodic sensor updates
-        self.sensor_cb = ioloop.PeriodicCallback(self.do_sensor, 1000)
+        self.sensor_cb = ioloop.PeriodicCallback(self.do_sensor,
+                                                 self.config.sensor_period)
         self.sensor_cb.start()
 
-        self.control = ioloop.PeriodicCallback(self.do_control, 1000)
+        self.control = ioloop.PeriodicCallback(self.do_control,
+                                               self.config.control_period)
         self.control.start()
 
+        # setup periodic summaries of the application reports
+        self.report_cb = ioloop.PeriodicCallback(self.do_report,
+                                                 self.config.report_period)
+        self.report_cb.start()
+
         # take care of signals
+        self.reaper = Reaper(self.do_children,
+                             lambda: self.container_manager.pids)
         signal.signal(signal.SIGINT, self.do_signal)
         signal.signal(signal.SIGCHLD, self.do_signal)
 
@@ -322,10 +489,19 @@ class Daemon(object):
 def runner(config):
     if config.verbose:
         logger.setLevel(logging.DEBUG)
+    logs.set_levels(config.log_level)
+    if config.log_rate > 0:
+        logs.rate_limit(logs.hot_categories, burst=config.log_rate)
 
+    listener = None
     if config.nrm_log:
         print("Logging to %s" % config.nrm_log)
-        logger.addHandler(logging.FileHandler(config.nrm_log))
+        listener = logs.log_to_file(logger, config.nrm_log,
+                                    max_bytes=config.nrm_log_size)
 
     daemon = Daemon(config)
-    daemon.main()
+    try:
+        daemon.main()
+    finally:
+        if listener:
+            listener.stop()
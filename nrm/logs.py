@@ -0,0 +1,155 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Logs Module:
+    configure the logging of the daemon.
+
+    Logs are split in categories, the children of the 'nrm' logger (e.g.,
+    nrm.messaging), whose level can be set separately. Categories logged on
+    every message or tick are rate limited, and records are written to the
+    log file by a background thread, so that verbose logging costs the
+    ioloop little more than building the records.
+"""
+from __future__ import print_function
+import logging
+import logging.handlers
+import Queue
+import threading
+
+# categories logged from the hot paths of the daemon
+hot_categories = ['nrm.messaging', 'nrm.events', 'nrm.sensor', 'nrm.output']
+
+
+class RateLimitFilter(logging.Filter):
+
+    """Lets through at most burst records of each message of a logger per
+    period seconds. The first record let through after some were dropped
+    tells how many."""
+
+    def __init__(self, burst=10, period=1.0):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.period = period
+        self.windows = dict()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        start, count, dropped = self.windows.get(key, (0.0, 0, 0))
+        if record.created - start >= self.period:
+            start, count = record.created, 0
+        if count >= self.burst:
+            self.windows[key] = (start, count, dropped + 1)
+            return False
+        self.windows[key] = (start, count + 1, 0)
+        if dropped and isinstance(record.args, tuple):
+            record.msg = "%s [%%d similar messages dropped]" % record.msg
+            record.args = record.args + (dropped,)
+        return True
+
+
+class QueueHandler(logging.Handler):
+
+    """Hands records over to a queue, dropping them if it is full. The next
+    record queued tells how many were dropped.
+
+    Messages are formatted before being queued, as their arguments might
+    change afterwards."""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if self.dropped:
+                record.msg = "%s [%d records dropped]" % (record.msg,
+                                                          self.dropped)
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+
+    """Thread passing the records of a queue to handlers."""
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """Write the queued records and stop the thread."""
+        self.queue.put(self._sentinel)
+        self.thread.join()
+        self.thread = None
+
+
+def set_levels(specs):
+    """Set the level of log categories, from a list of category=LEVEL
+    strings. Categories are relative to the nrm logger."""
+    for spec in specs or []:
+        category, level = spec.split('=', 1)
+        name = 'nrm.' + category if category else 'nrm'
+        logging.getLogger(name).setLevel(level.upper())
+
+
+def rate_limit(names, burst=10, period=1.0):
+    """Rate limit the records of some loggers."""
+    f = RateLimitFilter(burst, period)
+    for name in names:
+        logging.getLogger(name).addFilter(f)
+    return f
+
+
+def log_to_file(logger, path, max_bytes=0, backups=1, queue_size=10000):
+    """Write the records of a logger to a file from a background thread.
+
+    The file is rotated once it reaches max_bytes, if not 0. Returns the
+    listener, to stop when done."""
+    queue = Queue.Queue(queue_size)
+    target = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes,
+                                                  backupCount=backups)
+    target.setFormatter(logging.Formatter(
+        "%(asctime)s %(name)s %(levelname)s %(message)s"))
+    listener = QueueListener(queue, target)
+    listener.start()
+    logger.addHandler(QueueHandler(queue))
+    return listener
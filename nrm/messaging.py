@@ -8,28 +8,195 @@
 # SPDX-License-Identifier: BSD-3-Clause
 ###############################################################################
 
+import collections
 import json
 import logging
+import struct
+import time
 import uuid
 import zmq
 import zmq.utils
 import zmq.utils.monitor
-from zmq.eventloop import zmqstream
-from schema import loadschema
-
-
-_logger = logging.getLogger('nrm')
-_UpstreamRep = loadschema('json', 'upstreamRep')
-_UpstreamPub = loadschema('json', 'upstreamPub')
+from jsonschema import ValidationError
+from tornado.concurrent import Future
+from zmq.eventloop import ioloop, zmqstream
+from schema import loadvalidators
+
+
+_logger = logging.getLogger('nrm.messaging')
+
+# validators are compiled once for each API, and indexed by message tag
+_validators = {api: loadvalidators('json', api)
+               for api in ['upstreamReq', 'upstreamRep', 'upstreamPub',
+                           'downstreamEvent']}
+
+
+class Message(dict):
+
+    """A message of one of the NRM APIs: a dictionary whose fields can also
+    be accessed as attributes."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def message(apiname, msg, validate=True):
+    """Builds a Message of an API from a dictionary, checking it against the
+    schema of its tag unless validate is False. Raises ValidationError on
+    invalid messages.
+
+    The events of a batch message are checked and built individually."""
+    if validate:
+        try:
+            validator = _validators[apiname][msg['tag']]
+        except (KeyError, TypeError):
+            raise ValidationError("invalid %s message: %r" % (apiname, msg))
+        validator.validate(msg)
+    msg = Message(msg)
+    if msg.get('tag') == 'batch':
+        msg.events = [message(apiname, e, validate) for e in msg.events]
+    return msg
+
+
+class StructCodec(object):
+
+    """Compact binary encoding of the messages of an API.
+
+    Each tag has a fixed layout: a header made of a magic byte and the tag
+    code, the numerical fields of the tag packed as little-endian C types,
+    then its string fields, each one prefixed by its length. The magic
+    byte can never start a JSON document, so that both encodings can be
+    received on the same socket.
+
+    layouts is a list of (tag, struct format of the numerical fields, names
+    of the numerical fields, names of the string fields). Tag codes are
+    positions in this list, starting at 1. Empty strings are not encoded
+    in the message, so that optional string fields can be part of a
+    layout.
+
+    Code 0 is reserved for batches: the header is followed by the number
+    of events, then by the events themselves, each one with its own
+    header."""
+
+    magic = b'\x01'
+    header = struct.Struct('<cB')
+    strlen = struct.Struct('<H')
+    batch_code = 0
+
+    def __init__(self, layouts):
+        self.encoders = dict()
+        self.decoders = dict()
+        for code, (tag, fmt, numbers, strings) in enumerate(layouts, 1):
+            st = struct.Struct(self.header.format + fmt)
+            self.encoders[tag] = (code, st, numbers, strings)
+            self.decoders[code] = (tag, st, numbers, strings)
+
+    def encode(self, msg):
+        if msg['tag'] == 'batch':
+            events = msg['events']
+            return b''.join([self.header.pack(self.magic, self.batch_code),
+                             self.strlen.pack(len(events))] +
+                            [self.encode(e) for e in events])
+        code, st, numbers, strings = self.encoders[msg['tag']]
+        parts = [st.pack(self.magic, code, *[msg[k] for k in numbers])]
+        for k in strings:
+            v = msg.get(k, u'').encode('utf-8')
+            parts.append(self.strlen.pack(len(v)))
+            parts.append(v)
+        return b''.join(parts)
+
+    def decode_from(self, wire, offset=0):
+        """Decodes the message starting at offset, returns it along with the
+        offset of its end."""
+        if wire[offset] != self.magic:
+            raise KeyError(wire[offset])
+        code = ord(wire[offset+1])
+        if code == self.batch_code:
+            count, = self.strlen.unpack_from(wire, offset+self.header.size)
+            offset += self.header.size + self.strlen.size
+            events = []
+            for i in range(count):
+                event, offset = self.decode_from(wire, offset)
+                events.append(event)
+            return {'tag': 'batch', 'events': events}, offset
+        tag, st, numbers, strings = self.decoders[code]
+        values = st.unpack_from(wire, offset)
+        msg = dict(zip(numbers, values[2:]))
+        msg['tag'] = tag
+        offset += st.size
+        for k in strings:
+            n, = self.strlen.unpack_from(wire, offset)
+            offset += self.strlen.size
+            if n:
+                msg[k] = wire[offset:offset+n].decode('utf-8')
+            offset += n
+        return msg, offset
+
+    def decode(self, wire):
+        """Decodes a message. Raises ValueError on malformed input."""
+        try:
+            msg, offset = self.decode_from(wire)
+        except (KeyError, IndexError, struct.error, UnicodeDecodeError):
+            raise ValueError("malformed binary message: %r" % wire)
+        if offset != len(wire):
+            raise ValueError("malformed binary message: %r" % wire)
+        return msg
+
+
+# binary layouts, for APIs that support them. Layouts can only be appended
+# to, since tag codes are their positions.
+_codecs = {
+        'downstreamEvent': StructCodec([
+            ('start', '', [], ['container_uuid', 'application_uuid']),
+            ('exit', '', [], ['application_uuid']),
+            ('performance', 'd', ['payload'],
+                ['container_uuid', 'application_uuid']),
+            ('progress', 'd', ['payload'], ['application_uuid']),
+            ('phasecontext', 'i4d',
+                ['cpu', 'startcompute', 'endcompute', 'startbarrier',
+                 'endbarrier'],
+                ['application_uuid']),
+            ]),
+        }
+
+encodings = ['json', 'binary']
+
+
+def encode(apiname, msg, encoding='json'):
+    """Serializes a message for the wire."""
+    if encoding == 'binary':
+        return _codecs[apiname].encode(msg)
+    return json.dumps(msg)
+
+
+def decode(apiname, wire):
+    """Deserializes a message from the wire, in either encoding."""
+    if wire[:1] == StructCodec.magic:
+        try:
+            codec = _codecs[apiname]
+        except KeyError:
+            raise ValueError("no binary encoding for %s" % apiname)
+        return codec.decode(wire)
+    return json.loads(wire)
 
 
 def send(apiname):
     def wrap(cls):
-        model = loadschema('json', apiname)
-
         def send(self, *args, **kwargs):
-            self.socket.send(
-                    json.dumps(model(dict(*args, **kwargs))))
+            msg = message(apiname, dict(*args, **kwargs), self.validate)
+            self.socket.send(encode(apiname, msg, self.encoding))
         setattr(cls, "send", send)
 
         return(cls)
@@ -38,20 +205,18 @@ def send(apiname):
 
 def recv_callback(apiname):
     def wrap(cls):
-        model = loadschema('json', apiname)
-
         def recv(self):
             """Receives a response to a message."""
             wire = self.socket.recv()
             _logger.debug("received message: %r", wire)
-            return model(json.loads(wire))
+            return message(apiname, decode(apiname, wire), self.validate)
 
         def do_recv_callback(self, frames):
             """Receives a message from zmqstream.on_recv, passing it to a user
             callback."""
-            _logger.info("receiving message: %r", frames)
+            _logger.debug("receiving message: %r", frames)
             assert len(frames) == 2
-            msg = model(json.loads(frames[1]))
+            msg = message(apiname, decode(apiname, frames[1]), self.validate)
             assert self.callback
             self.callback(msg, str(frames[0]))
 
@@ -73,14 +238,18 @@ class RPCClient(object):
 
     """Implements the message layer client to the upstream RPC API."""
 
-    def __init__(self, address):
+    def __init__(self, address, validate=True):
         self.address = address
+        self.validate = validate
+        self.encoding = 'json'
         self.uuid = str(uuid.uuid4())
         self.zmq_context = zmq.Context.instance()
         self.socket = self.zmq_context.socket(zmq.DEALER)
         self.socket.setsockopt(zmq.IDENTITY, self.uuid)
         self.socket.setsockopt(zmq.SNDHWM, 0)
-        self.socket.setsockopt(zmq.RCVHWM, 0)
+        # bounded, so that a client slow to read holds the daemon back
+        # instead of queuing its output
+        self.socket.setsockopt(zmq.RCVHWM, 1000)
 
     def connect(self, wait=True):
         """Connect, and wait for the socket to be connected."""
@@ -97,14 +266,20 @@ class RPCClient(object):
 
 class RPCServer(object):
 
-    """Implements the message layer server to the upstream RPC API."""
+    """Implements the message layer server to the upstream RPC API.
+
+    With a hwm, at most hwm messages are queued in ZMQ for each client, and
+    sending to an unknown client fails instead of dropping the message."""
 
-    def __init__(self, address):
+    def __init__(self, address, validate=True, hwm=0):
         self.address = address
+        self.validate = validate
         self.zmq_context = zmq.Context.instance()
         self.socket = self.zmq_context.socket(zmq.ROUTER)
-        self.socket.setsockopt(zmq.SNDHWM, 0)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
         self.socket.setsockopt(zmq.RCVHWM, 0)
+        if hwm:
+            self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
         self.socket.bind(address)
 
 
@@ -117,48 +292,149 @@ class UpstreamRPCClient(RPCClient):
         """Receives a response to a message."""
         wire = self.socket.recv()
         _logger.debug("received message: %r", wire)
-        return _UpstreamRep(json.loads(wire))
+        return message('upstreamRep', json.loads(wire), self.validate)
 
 
 @recv_callback("upstreamReq")
 class UpstreamRPCServer(RPCServer):
 
-    """Implements the message layer server to the upstream RPC API."""
+    """Implements the message layer server to the upstream RPC API.
+
+    Messages to a client whose ZMQ queue is full wait in order in a pending
+    queue, retried every retry_period seconds. Callers producing many
+    messages can wait for them to leave (see drained)."""
+
+    retry_period = 0.01
+
+    def __init__(self, address, validate=True, hwm=0):
+        super(UpstreamRPCServer, self).__init__(address, validate, hwm)
+        self.pending = dict()
+        self.waiters = dict()
+        self.retries = dict()
 
     def send(self, client_uuid, *args, **kwargs):
         """Sends a message to the identified client."""
-        msg = json.dumps(_UpstreamRep(dict(*args, **kwargs)))
+        msg = json.dumps(message('upstreamRep', dict(*args, **kwargs),
+                                 self.validate))
         _logger.debug("sending message: %r to client: %r", msg, client_uuid)
-        self.socket.send_multipart([client_uuid, msg])
+        self.pending.setdefault(client_uuid, collections.deque()).append(msg)
+        self.flush(client_uuid)
+
+    def flush(self, client_uuid):
+        """Hand the pending messages of a client over to ZMQ, as long as
+        its queue has room."""
+        pending = self.pending.get(client_uuid)
+        while pending:
+            try:
+                self.socket.send_multipart([client_uuid, pending[0]],
+                                           zmq.NOBLOCK)
+            except zmq.Again:
+                if client_uuid not in self.retries:
+                    self.retries[client_uuid] = \
+                        ioloop.IOLoop.current().call_later(
+                            self.retry_period, self.retry, client_uuid)
+                return
+            except zmq.ZMQError as e:
+                if e.errno != zmq.EHOSTUNREACH:
+                    raise
+                _logger.warning("client %r is gone, dropping %d messages",
+                                client_uuid, len(pending))
+                break
+            pending.popleft()
+        self.pending.pop(client_uuid, None)
+        for future in self.waiters.pop(client_uuid, []):
+            future.set_result(None)
+
+    def retry(self, client_uuid):
+        del self.retries[client_uuid]
+        self.flush(client_uuid)
+
+    def drained(self, client_uuid):
+        """Return a future resolved once no message to the client is
+        pending anymore."""
+        future = Future()
+        if client_uuid in self.pending:
+            self.waiters.setdefault(client_uuid, []).append(future)
+        else:
+            future.set_result(None)
+        return future
+
+
+def pub_topic(tag, container_uuid=None):
+    """Returns the topic frame of upstream pub messages.
+
+    Topics are the message tag and the container uuid (if any), each one
+    terminated by a null byte, so that subscribing to a topic prefix only
+    matches whole fields."""
+    cid = container_uuid or u''
+    return b'%s\0%s\0' % (tag.encode('utf-8'), cid.encode('utf-8'))
 
 
-@send("upstreamPub")
 class UpstreamPubServer(object):
 
-    """Implements the message layer server for the upstream PUB/SUB API."""
+    """Implements the message layer server for the upstream PUB/SUB API.
 
-    def __init__(self, address):
+    Messages are sent with a topic frame (see pub_topic) so that clients
+    only receive the messages they subscribed to."""
+
+    def __init__(self, address, validate=True):
         self.address = address
+        self.validate = validate
         self.zmq_context = zmq.Context.instance()
         self.socket = self.zmq_context.socket(zmq.PUB)
         self.socket.setsockopt(zmq.LINGER, 0)
         self.socket.setsockopt(zmq.SNDHWM, 0)
         self.socket.bind(address)
 
+    def send(self, *args, **kwargs):
+        msg = message('upstreamPub', dict(*args, **kwargs), self.validate)
+        self.socket.send_multipart([pub_topic(msg.tag,
+                                              msg.get('container_uuid')),
+                                    json.dumps(msg)])
+
 
 class UpstreamPubClient(object):
 
-    """Implements the message layer client to the upstream Pub API."""
+    """Implements the message layer client to the upstream Pub API.
+
+    Filtering happens in ZMQ, before messages are decoded: clients
+    receive everything, unless they subscribe to specific tags or
+    containers before connecting."""
 
-    def __init__(self, address):
+    def __init__(self, address, validate=True):
         self.address = address
+        self.validate = validate
+        self.subscriptions = set()
         self.zmq_context = zmq.Context.instance()
         self.socket = self.zmq_context.socket(zmq.SUB)
         self.socket.setsockopt(zmq.RCVHWM, 0)
-        self.socket.setsockopt(zmq.SUBSCRIBE, '')
+
+    def subscribe(self, tag=None, container_uuid=None):
+        """Receive the messages matching a tag and/or a container uuid."""
+        if tag and container_uuid:
+            topics = [pub_topic(tag, container_uuid)]
+        elif tag:
+            topics = [tag.encode('utf-8') + b'\0']
+        elif container_uuid:
+            topics = [pub_topic(t, container_uuid)
+                      for t in _validators['upstreamPub']]
+        else:
+            topics = [b'']
+        for topic in topics:
+            if topic not in self.subscriptions:
+                self.socket.setsockopt(zmq.SUBSCRIBE, topic)
+                self.subscriptions.add(topic)
+
+    def subscribe_tag(self, tag):
+        self.subscribe(tag=tag)
+
+    def subscribe_container(self, container_uuid):
+        self.subscribe(container_uuid=container_uuid)
 
     def connect(self, wait=True):
         """Creates a monitor socket and wait for the connect event."""
+        if not self.subscriptions:
+            self.subscribe()
         monitor = self.socket.get_monitor_socket()
         self.socket.connect(self.address)
         while wait:
@@ -173,16 +449,17 @@ class UpstreamPubClient(object):
         """Receives a message and returns it."""
         frames = self.socket.recv_multipart()
         _logger.debug("received message: %r", frames)
-        assert len(frames) == 1
-        return _UpstreamPub(json.loads(frames[0]))
+        assert len(frames) == 2
+        return message('upstreamPub', json.loads(frames[1]), self.validate)
 
     def do_recv_callback(self, frames):
         """Receives a message from zmqstream.on_recv, passing it to a user
         callback."""
-        _logger.info("receiving message: %r", frames)
-        assert len(frames) == 1
+        _logger.debug("receiving message: %r", frames)
+        assert len(frames) == 2
         assert self.callback
-        self.callback(_UpstreamPub(json.loads(frames[0])))
+        self.callback(message('upstreamPub', json.loads(frames[1]),
+                              self.validate))
 
     def setup_recv_callback(self, callback):
         """Setup a ioloop-backed callback for receiving messages."""
@@ -198,8 +475,50 @@ class DownstreamEventServer(RPCServer):
     """Implements the message layer server for the downstream event API."""
 
 
-@send("downstreamEvent")
 class DownstreamEventClient(RPCClient):
-    pass
 
-    """Implements the message layer client for the downstream event API."""
+    """Implements the message layer client for the downstream event API.
+
+    Messages are sent in the given encoding, either 'json' or the compact
+    'binary' one. The server accepts both on the same socket.
+
+    If batch_size is larger than one, events are buffered and sent together
+    in a single batch message, once batch_size events are buffered or the
+    oldest one is batch_period seconds old. The age of the buffer is only
+    checked when sending, so clients going idle should call flush. Exit
+    events are never delayed."""
+
+    def __init__(self, address, validate=True, encoding='json',
+                 batch_size=1, batch_period=None):
+        super(DownstreamEventClient, self).__init__(address, validate)
+        assert encoding in encodings
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.batch_period = batch_period
+        self.events = []
+        self.batch_start = None
+
+    def send(self, *args, **kwargs):
+        msg = message('downstreamEvent', dict(*args, **kwargs), self.validate)
+        if self.batch_size <= 1:
+            self.socket.send(encode('downstreamEvent', msg, self.encoding))
+            return
+        if not self.events:
+            self.batch_start = time.time()
+        self.events.append(msg)
+        if (len(self.events) >= self.batch_size or msg.tag == 'exit' or
+                (self.batch_period is not None and
+                 time.time() - self.batch_start >= self.batch_period)):
+            self.flush()
+
+    def flush(self):
+        """Sends the buffered events, if any."""
+        if not self.events:
+            return
+        if len(self.events) == 1:
+            msg = self.events[0]
+        else:
+            msg = {'tag': 'batch', 'events': self.events}
+        self.socket.send(encode('downstreamEvent', msg, self.encoding))
+        self.events = []
+        self.batch_start = None
@@ -0,0 +1,150 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Output Module:
+    forward the output of the children of the daemon.
+
+    Output is coalesced into batches, sent when they reach a size bound or
+    when the oldest data in them is older than a time bound, instead of one
+    message per read. Batches sent on size end on a line boundary when
+    possible, batches sent on time hold whatever was read, partial lines
+    included.
+
+    A child is not read while a full batch is being written, so that a slow
+    destination slows the child down instead of growing the memory of the
+    daemon. For the RPC socket, a write is done once the message is queued
+    in ZMQ, which holds a bounded number of messages per client (see the
+    rpc_hwm option of nrmd).
+"""
+from __future__ import print_function
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from tornado import gen, locks
+from tornado.concurrent import run_on_executor
+from tornado.iostream import StreamClosedError
+from zmq.eventloop import ioloop
+
+logger = logging.getLogger('nrm.output')
+spool_executor = ThreadPoolExecutor(max_workers=1)
+
+
+class OutputForwarder(object):
+
+    """Reads a child stream, and passes its output to write by batches of
+    about max_size bytes, at most max_delay seconds late. done is called
+    once the stream is closed and all its output written.
+
+    write can return a future, in which case the next batches wait for
+    it."""
+
+    def __init__(self, stream, write, done, max_size=65536, max_delay=0.05):
+        self.stream = stream
+        self.write = write
+        self.done = done
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.chunks = []
+        self.size = 0
+        self.timer = None
+        self.lock = locks.Lock()
+
+    def start(self):
+        ioloop.IOLoop.current().spawn_callback(self.run)
+
+    @gen.coroutine
+    def run(self):
+        while True:
+            try:
+                data = yield self.stream.read_bytes(self.max_size,
+                                                    partial=True)
+            except StreamClosedError:
+                break
+            self.chunks.append(data)
+            self.size += len(data)
+            if self.size >= self.max_size:
+                flushed = self.flush(lines=True)
+                # the partial line left behind is still time bounded
+                if self.chunks:
+                    self.arm_timer()
+                yield self.wait_flushed(flushed)
+            else:
+                self.arm_timer()
+        if self.timer is not None:
+            ioloop.IOLoop.current().remove_timeout(self.timer)
+            self.timer = None
+        yield self.wait_flushed(self.flush())
+        self.done()
+
+    def arm_timer(self):
+        if self.timer is None:
+            self.timer = ioloop.IOLoop.current().call_later(
+                    self.max_delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        ioloop.IOLoop.current().add_future(self.flush(), self.on_flushed)
+
+    def on_flushed(self, future):
+        """Report the failure of a timed flush, nothing waits on it."""
+        try:
+            future.result()
+        except Exception:
+            logger.exception("could not write child output")
+
+    @gen.coroutine
+    def wait_flushed(self, future):
+        """Wait for a flush. On failure, the output is lost but the stream
+        is still read, and done still called."""
+        try:
+            yield future
+        except Exception:
+            logger.exception("could not write child output")
+
+    @gen.coroutine
+    def flush(self, lines=False):
+        """Write the buffered output. With lines, an incomplete last line
+        stays in the buffer, unless it is all there is."""
+        data = b''.join(self.chunks)
+        rest = b''
+        if lines:
+            end = data.rfind(b'\n') + 1
+            if end:
+                data, rest = data[:end], data[end:]
+        self.chunks = [rest] if rest else []
+        self.size = len(rest)
+        if not data:
+            return
+        # keep batches in order when writes take a while
+        with (yield self.lock.acquire()):
+            yield gen.maybe_future(self.write(data))
+
+
+class SpoolFile(object):
+
+    """Appends output to a file, off the ioloop."""
+
+    def __init__(self, path):
+        self.path = path
+        self.executor = spool_executor
+        self.file = open(path, 'ab')
+
+    @run_on_executor
+    def write(self, data):
+        self.file.write(data)
+
+    @run_on_executor
+    def close(self):
+        self.file.close()
+
+
+def spool_path(directory, container_uuid, io):
+    """Return the file the io stream of a container is spooled to."""
+    return os.path.join(directory, "%s.%s" % (container_uuid, io))
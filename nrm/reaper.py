@@ -0,0 +1,73 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Reaper Module:
+    collect the exit status of the children of the daemon.
+
+    SIGCHLD only tells that at least one child changed state, and a burst of
+    exits raises a burst of signals. The reaper schedules a single
+    collection on the ioloop for all the signals received until it runs, and
+    hands the exits over in batches, giving the ioloop back between batches.
+
+    Only the pids the daemon launched are waited for: other children, like
+    the ones of subprocess in executor threads, are left to their owners.
+"""
+from __future__ import print_function
+import errno
+import logging
+import os
+from zmq.eventloop import ioloop
+
+logger = logging.getLogger('nrm')
+
+
+class Reaper(object):
+
+    """Waits for the children whose pids are returned by pids on SIGCHLD,
+    and passes their (pid, status, rusage) to callback, by batches of at
+    most batch_size."""
+
+    def __init__(self, callback, pids, batch_size=64):
+        self.callback = callback
+        self.pids = pids
+        self.batch_size = batch_size
+        self.scheduled = False
+
+    def signal(self):
+        """Schedule a collection. Safe to call from a signal handler."""
+        if not self.scheduled:
+            self.scheduled = True
+            ioloop.IOLoop.current().add_callback_from_signal(self.reap)
+
+    def reap(self):
+        """Collect a batch of child updates and pass it to the callback."""
+        self.scheduled = False
+        batch = []
+        for pid in list(self.pids()):
+            if len(batch) == self.batch_size:
+                break
+            try:
+                pid, status, rusage = os.wait4(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                # reaped by someone else, the status is lost
+                logger.error("child %d already reaped", pid)
+                batch.append((pid, 0, None))
+                continue
+            if pid != 0:
+                batch.append((pid, status, rusage))
+        if len(batch) == self.batch_size:
+            # more children might be waiting, come back after the others
+            self.scheduled = True
+            ioloop.IOLoop.current().add_callback(self.reap)
+        if batch:
+            logger.info("reaped %d children", len(batch))
+            self.callback(batch)
@@ -16,36 +16,289 @@ from subprograms import HwlocClient, resources
 logger = logging.getLogger('nrm')
 
 
+def _tomask(indexes):
+    """Convert a list of resource indexes into an integer bitmask."""
+    m = 0
+    for i in indexes:
+        m |= 1 << i
+    return m
+
+
+def _tolist(mask):
+    """Convert an integer bitmask into the sorted list of its indexes."""
+    ret = []
+    while mask:
+        low = mask & -mask
+        ret.append(low.bit_length() - 1)
+        mask ^= low
+    return ret
+
+
+def _lowest(mask, n):
+    """Return the mask of the n lowest bits set in mask."""
+    ret = 0
+    for i in range(n):
+        low = mask & -mask
+        ret |= low
+        mask ^= low
+    return ret
+
+
+def _count(mask):
+    return bin(mask).count('1')
+
+
+def _localmems(rm, cpus, n):
+    """Pick n free memory nodes, the ones local to most of the cpus first.
+
+    Like first fit, the last free memory node is shared."""
+    free = rm.free['mems']
+    if _count(free) <= 1:
+        return free
+    nodes = sorted((-_count(mask & cpus), idx) for idx, mask in rm.numanodes
+                   if free >> idx & 1)
+    return _tomask(idx for _, idx in nodes[:n])
+
+
+class FirstFitPlacement(object):
+
+    """Takes the lowest numbered free cpus and memory nodes."""
+
+    def place(self, rm, request):
+        free = rm.free['cpus']
+        freemems = rm.free['mems']
+        if _count(free) >= request.cpus:
+            cpus = _lowest(free, request.cpus)
+        else:
+            cpus = 0
+        if _count(freemems) > 1:
+            mems = _lowest(freemems, request.mems)
+        else:
+            mems = freemems
+        return cpus, mems
+
+
+class CompactPlacement(object):
+
+    """Fills packages one at a time: the request goes to the package with
+    the fewest free cpus that can hold it, or is split over the packages
+    with the most free cpus. Memory nodes local to the cpus come first."""
+
+    def place(self, rm, request):
+        free = rm.free['cpus']
+        n = request.cpus
+        if _count(free) < n:
+            return 0, 0
+        pkgs = [(_count(free & p), p) for p in rm.packages]
+        fits = [(c, p) for c, p in pkgs if c >= n]
+        if fits:
+            cpus = _lowest(free & min(fits)[1], n)
+        else:
+            cpus = 0
+            for c, p in sorted(pkgs, key=lambda x: -x[0]):
+                take = _lowest(free & p, min(n, c))
+                cpus |= take
+                n -= _count(take)
+                if not n:
+                    break
+        return cpus, _localmems(rm, cpus, request.mems)
+
+
+class ScatterPlacement(object):
+
+    """Spreads cpus across packages, one at a time, starting with the
+    packages with the most free cpus. Memory nodes local to the cpus come
+    first."""
+
+    def place(self, rm, request):
+        free = rm.free['cpus']
+        n = request.cpus
+        if _count(free) < n:
+            return 0, 0
+        pkgs = sorted((free & p for p in rm.packages), key=_count,
+                      reverse=True)
+        cpus = 0
+        while n:
+            for i, p in enumerate(pkgs):
+                if n and p:
+                    low = p & -p
+                    cpus |= low
+                    pkgs[i] ^= low
+                    n -= 1
+        return cpus, _localmems(rm, cpus, request.mems)
+
+
+class NumaPlacement(object):
+
+    """Takes cpus and memory from the same NUMA nodes: the node with the
+    fewest free cpus that can hold the request, or the nodes with the most
+    free cpus until there are enough cpus and memory nodes. Only nodes
+    with free memory are considered, falls back to compact placement
+    otherwise.
+
+    The memory nodes of the slice are all the nodes its cpus come from,
+    which can be more than requested."""
+
+    def place(self, rm, request):
+        free = rm.free['cpus']
+        freemems = rm.free['mems']
+        n = request.cpus
+        if _count(free) < n:
+            return 0, 0
+        nodes = [(_count(free & mask), idx, free & mask)
+                 for idx, mask in rm.numanodes
+                 if freemems >> idx & 1 and free & mask]
+        fits = [node for node in nodes if node[0] >= n]
+        if request.mems <= 1 and fits:
+            count, idx, avail = min(fits)
+            return _lowest(avail, n), 1 << idx
+        cpus = 0
+        mems = 0
+        for count, idx, avail in sorted(nodes, key=lambda x: -x[0]):
+            take = _lowest(avail, min(n - _count(cpus), count))
+            cpus |= take
+            mems |= 1 << idx
+            if _count(cpus) >= n and _count(mems) >= request.mems:
+                return cpus, mems
+        return CompactPlacement().place(rm, request)
+
+
+def _bestfit(group, free, n):
+    """Take n free cpus from a group of the topology, keeping the free cpus
+    of its subgroups together as much as possible."""
+    mask, children = group
+    avail = free & mask
+    if _count(avail) == n or not children:
+        return _lowest(avail, n)
+    counts = [(_count(free & c[0]), i) for i, c in enumerate(children)]
+    fits = [(count, i) for count, i in counts if count >= n]
+    if fits:
+        return _bestfit(children[min(fits)[1]], free, n)
+    ret = 0
+    for count, i in sorted(counts, reverse=True):
+        take = min(count, n - _count(ret))
+        if not take:
+            break
+        ret |= _bestfit(children[i], free, take)
+    return ret
+
+
+class BestFitPlacement(object):
+
+    """Takes cpus from the smallest group of the topology (core, cache,
+    package, NUMA node) whose free cpus can hold the request, so that
+    larger free groups stay available for larger requests. Memory nodes
+    local to the cpus come first."""
+
+    def place(self, rm, request):
+        free = rm.free['cpus']
+        if _count(free) < request.cpus:
+            return 0, 0
+        cpus = _bestfit(rm.groups, free, request.cpus)
+        return cpus, _localmems(rm, cpus, request.mems)
+
+
+placement_policies = {'first': FirstFitPlacement,
+                      'bestfit': BestFitPlacement,
+                      'compact': CompactPlacement,
+                      'scatter': ScatterPlacement,
+                      'numa': NumaPlacement,
+                      }
+
+
 class ResourceManager(object):
 
     """Manages the query of node resources, the tracking of their use and
-    the scheduling of new containers according to partitioning rules."""
+    the scheduling of new containers according to partitioning rules.
 
-    def __init__(self, hwloc):
+    Resources are tracked as integer bitmasks, one per resource type, so
+    that allocating and freeing are a few word operations. Callers still
+    exchange resources namedtuples.
+
+    Where a slice is taken from is decided by a placement policy (see
+    placement_policies), the default one or the one given to schedule."""
+
+    def __init__(self, hwloc, placement='first'):
         self.hwloc = HwlocClient(hwloc=hwloc)
 
         # query the node topo, keep track of the critical resources
-        self.allresources = self.hwloc.info()
+        topology = self.hwloc.gettopology()
+        self.allresources = topology.resources()
         logger.debug("resource info: %r", self.allresources)
-        self.available = self.allresources
+        self.free = {attr: _tomask(val) for attr, val
+                     in self.allresources._asdict().items()}
         self.allocations = {}
+        self.masks = {}
+
+        # cpus of each package and NUMA node, for placement
+        allcpus = self.free['cpus']
+        self.packages = [_tomask(o.cpuset) for o in
+                         topology.objects('Package', 'Socket')] or [allcpus]
+        self.numanodes = [(o.os_index, _tomask(o.cpuset)) for o in
+                          topology.numanodes] or [(0, allcpus)]
+        self.groups = self._groups(topology, topology.root)
+        self.placement = placement
+        self.policies = {k: v() for k, v in placement_policies.items()}
+
+    @property
+    def available(self):
+        """The available resources."""
+        return resources(**{attr: _tolist(m) for attr, m in self.free.items()})
+
+    def _groups(self, topology, obj):
+        """Return the tree of cpu masks of the topology, as (mask, list of
+        children) tuples. Objects with the same cpus as their only child
+        are skipped."""
+        children = topology.cpuchildren(obj)
+        while len(children) == 1 and children[0].cpuset == obj.cpuset:
+            obj = children[0]
+            children = topology.cpuchildren(obj)
+        return (_tomask(obj.cpuset),
+                [self._groups(topology, c) for c in children])
+
+    def largest_slice(self):
+        """Return the largest NUMA-local slice that can be allocated: the
+        free cpus of the NUMA node with free memory that has the most."""
+        ret = resources([], [])
+        for idx, mask in self.numanodes:
+            if self.free['mems'] >> idx & 1:
+                cpus = self.free['cpus'] & mask
+                if _count(cpus) > len(ret.cpus):
+                    ret = resources(_tolist(cpus), [idx])
+        return ret
+
+    def fragmentation(self):
+        """Return how scattered the free cpus are across NUMA nodes.
+
+        0 when the largest group of free cpus in a NUMA node is as large as
+        possible (the whole node, or all the free cpus), closer to 1 the
+        more the free cpus are spread across nodes."""
+        free = self.free['cpus']
+        total = _count(free)
+        if not total:
+            return 0.0
+        largest = max(_count(free & mask) for idx, mask in self.numanodes)
+        nodesize = max(_count(mask) for idx, mask in self.numanodes)
+        return 1.0 - float(largest) / min(total, nodesize)
 
-    def schedule(self, uuid, request):
+    def report(self):
+        """Return a summary of the free resources."""
+        return {'cpus': _count(self.free['cpus']),
+                'mems': _count(self.free['mems']),
+                'fragmentation': self.fragmentation(),
+                'largest_slice': dict(self.largest_slice()._asdict()),
+                }
+
+    def schedule(self, uuid, request, placement=None):
         """Schedule a resource request on the available resources.
 
-        Request is a dictionary of the resources asked for."""
-        # dumb scheduling, just give the first resources available:
+        Request is a dictionary of the resources asked for. Placement is
+        the name of the placement policy to use, the default one if None."""
         #  - cpus are exclusive
         #  - memories exclusive if more than one left
-        if len(self.available.cpus) >= request.cpus:
-            retcpus = sorted(self.available.cpus)[:request.cpus]
-        else:
-            retcpus = []
-        if len(self.available.mems) > 1:
-            retmems = sorted(self.available.mems)[:request.mems]
-        else:
-            retmems = self.available.mems
-        ret = resources(retcpus, retmems)
+        policy = self.policies[placement or self.placement]
+        retcpus, retmems = policy.place(self, request)
+        ret = resources(_tolist(retcpus), _tolist(retmems))
         # make sure we don't remember an error
         if ret.cpus:
             self.update(uuid, ret)
@@ -55,21 +308,20 @@ class ResourceManager(object):
         """Update resource tracking according to new allocation.
 
         The new allocation is saved, and available resources updated."""
-        added = {}
-        freed = {}
-        prev = self.allocations.get(uuid, resources([], []))
-        for attr, val in prev._asdict().items():
-            added[attr] = set(getattr(allocation, attr)) - set(val)
-            freed[attr] = set(val) - set(getattr(allocation, attr))
+        prev = self.masks.get(uuid, {'cpus': 0, 'mems': 0})
+        new = {attr: _tomask(val) for attr, val
+               in allocation._asdict().items()}
         if allocation != resources([], []):
             self.allocations[uuid] = allocation
-            logger.info("updated allocation for %r: %r", uuid,
-                        self.available)
+            self.masks[uuid] = new
+            logger.info("updated allocation for %r: %r", uuid, allocation)
         else:
             del self.allocations[uuid]
+            del self.masks[uuid]
             logger.info("deleted allocation for %r", uuid)
-        new = {}
-        for attr, val in self.available._asdict().items():
-            new[attr] = list(set(val) - set(added[attr]) | set(freed[attr]))
-        self.available = resources(**new)
-        logger.info("updated available resources: %r", self.available)
+        for attr in self.free:
+            added = new[attr] & ~prev[attr]
+            freed = prev[attr] & ~new[attr]
+            self.free[attr] = (self.free[attr] & ~added) | freed
+        logger.info("updated available resources: cpus %#x, mems %#x",
+                    self.free['cpus'], self.free['mems'])
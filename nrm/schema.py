@@ -18,7 +18,7 @@ _jsonexts = ["json"]
 _yamlexts = ["yml", "yaml"]
 
 
-def loadschema(ext, api):
+def _loadschema(ext, api):
     sourcedir = os.path.dirname(os.path.realpath(__file__))
     with open(os.path.join(sourcedir, "schemas", api+"."+ext)) as f:
         if ext in _jsonexts:
@@ -28,4 +28,24 @@ def loadschema(ext, api):
         else:
             raise("Schema extension not in %s" % str(_jsonexts + _yamlexts))
         Draft4Validator.check_schema(s)
-        return(warlock.model_factory(s))
+        return(s)
+
+
+def loadschema(ext, api):
+    return(warlock.model_factory(_loadschema(ext, api)))
+
+
+def loadvalidators(ext, api):
+    """Returns a dictionary of validators for a message API, indexed by tag.
+
+    Message APIs are a oneOf over the possible messages, each one fixing
+    its tag with a single-valued enum. Splitting the schema per tag lets a
+    message be checked against its own definition only, instead of
+    against every branch of the oneOf."""
+    s = _loadschema(ext, api)
+    validators = dict()
+    for branch in s['oneOf']:
+        for tag in branch['properties']['tag']['enum']:
+            assert tag not in validators
+            validators[tag] = Draft4Validator(branch)
+    return(validators)
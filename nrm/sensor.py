@@ -16,6 +16,8 @@
     This module should be the only one interfacing with coolr.
 """
 from __future__ import print_function
+import logging
+import threading
 import time
 import coolr
 import coolr.clr_rapl
@@ -23,38 +25,95 @@ import coolr.clr_hwmon
 import coolr.clr_nodeinfo
 import coolr.clr_cpufreq
 import coolr.clr_misc
+from telemetry import TelemetryStore
+
+logger = logging.getLogger('nrm')
 
 
 class SensorManager:
     """Performs sensor reading and basic data aggregation."""
 
-    def __init__(self):
+    def __init__(self, powerlimit_period=10.0, history_size=600):
+        """Create the coolr readers.
+
+        powerlimit_period is the maximum age, in seconds, of the cached power
+        limits. None disables periodic refreshes: the cache is then only
+        updated after a power limit change.
+
+        history_size is the number of samples kept for each measured value
+        in the telemetry history."""
         self.nodeconfig = coolr.clr_nodeinfo.nodeconfig()
         self.nodename = self.nodeconfig.nodename
         self.cputopology = coolr.clr_nodeinfo.cputopology()
         self.coretemp = coolr.clr_hwmon.coretemp_reader()
-        self.rapl = coolr.clr_rapl.rapl_reader()
+        self.cpufreq = coolr.clr_cpufreq.cpufreq_reader()
+        self.rapl = coolr.clr_rapl.rapl_reader(
+                powerlimit_period=powerlimit_period)
+        self.history = TelemetryStore(history_size)
+        # do_update might run in a SensorSampler thread while the daemon
+        # reads or changes power limits: updates are serialized as a whole,
+        # but rapl accesses only hold the rapl lock, so that a slow hwmon
+        # read never blocks a power limit change.
+        self.update_lock = threading.Lock()
+        self.rapl_lock = threading.Lock()
 
     def start(self):
-        self.rapl.start_energy_counter()
+        with self.rapl_lock:
+            self.rapl.start_energy_counter()
 
     def stop(self):
-        self.rapl.stop_energy_counter()
+        with self.rapl_lock:
+            self.rapl.stop_energy_counter()
+            self.rapl.close()
 
     def do_update(self):
-        machine_info = dict()
-        machine_info['energy'] = self.rapl.sample(accflag=True)
-        machine_info['temperature'] = self.coretemp.sample()
-        machine_info['time'] = time.time()
+        with self.update_lock:
+            machine_info = dict()
+            with self.rapl_lock:
+                machine_info['energy'] = self.rapl.sample(accflag=True)
+            machine_info['temperature'] = self.coretemp.sample()
+            if self.cpufreq.init:
+                self.cpufreq.sample()
+                machine_info['cpufreq'] = dict(zip(self.cpufreq.cpus,
+                                                   self.cpufreq.cpufreq()))
+            machine_info['time'] = time.time()
+            self.record(machine_info)
         return machine_info
 
-    def get_powerlimits(self):
-        pl = self.rapl.get_powerlimits()
+    def record(self, machine_info):
+        """Append the values of a sensor update to the history."""
+        t = machine_info['time']
+        rapl = machine_info['energy']
+        # the rapl reader returns None when no rapl sysfs is available
+        if rapl:
+            for kind in ('energy', 'power', 'powercap'):
+                for k, v in rapl[kind].items():
+                    self.history.append((kind, k), t, v)
+        for p, temps in machine_info['temperature'].items():
+            for k, v in temps.items():
+                self.history.append(('temperature', p, k), t, v)
+        for cpu, freq in machine_info.get('cpufreq', {}).items():
+            self.history.append(('cpufreq', cpu), t, freq)
+
+    def get_powerlimits(self, refresh=False):
+        """Return the power limits of enabled domains.
+
+        Served from the rapl reader cache, shared with do_update, unless
+        refresh is set."""
+        with self.rapl_lock:
+            pl = self.rapl.get_powerlimits(refresh)
         # only return enabled domains
         return {k: pl[k] for k in pl if pl[k]['enabled']}
 
     def set_powerlimit(self, domain, value):
-        self.rapl.set_powerlimit(value, domain)
+        with self.rapl_lock:
+            self.rapl.set_powerlimit(value, domain)
+
+    def set_powerlimits(self, limits):
+        """Set the power limits of several domains in one go."""
+        with self.rapl_lock:
+            for domain, value in limits.items():
+                self.rapl.set_powerlimit(value, domain)
 
     def calc_difference(self, start, end):
         diff = dict()
@@ -81,3 +140,43 @@ class SensorManager:
         diff['power'].pop('delta')
 
         return diff
+
+
+class SensorSampler(threading.Thread):
+
+    """Updates a SensorManager periodically from a dedicated thread.
+
+    Each update produces a new machine_info dictionary, published as
+    `snapshot` with a single reference assignment. The daemon picks up the
+    latest snapshot without blocking on sensor reads. Published snapshots are
+    never modified by the sampler, and must not be modified by readers
+    either."""
+
+    def __init__(self, sensor_manager, period):
+        """Create a sampler updating sensor_manager every period seconds."""
+        threading.Thread.__init__(self, name='nrm-sensor-sampler')
+        self.daemon = True
+        self.sensor_manager = sensor_manager
+        self.period = period
+        self.snapshot = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        deadline = time.time()
+        while not self.stopped.is_set():
+            try:
+                self.snapshot = self.sensor_manager.do_update()
+            except Exception:
+                logger.exception("sensor sampling failed")
+            deadline += self.period
+            delay = deadline - time.time()
+            if delay < 0:
+                # we fell behind, do not try to catch up with a burst
+                deadline = time.time()
+                delay = 0
+            self.stopped.wait(delay)
+
+    def stop(self):
+        """Stop sampling and wait for the thread to exit."""
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,184 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Simulation Module:
+    provide a stand-in for the SensorManager backed by a simple power model,
+    and a harness replaying power targets through a Controller, so that the
+    control loop can be evaluated and tuned without RAPL hardware.
+
+    Time is simulated: each sensor update advances the clock by one period,
+    so that replays are fast and, with a fixed seed, deterministic.
+"""
+from __future__ import print_function
+import random
+import timeit
+from telemetry import TelemetryStore
+
+
+class PowerModel(object):
+
+    """Power drawn by a RAPL domain, as a function of its cap.
+
+    The workload demand is a list of (start time, watts) phases. The drawn
+    power moves towards min(cap, demand) as a first order system with time
+    constant lag (in seconds), plus gaussian noise of standard deviation
+    noise (in watts)."""
+
+    def __init__(self, phases, cap=100.0, maxW=200.0, lag=0.5, noise=0.0,
+                 controlled=True):
+        self.phases = sorted(phases)
+        self.cap = cap
+        self.maxW = maxW
+        self.lag = lag
+        self.noise = noise
+        self.controlled = controlled
+        self.power = min(cap, self.demand(0.0))
+
+    def demand(self, t):
+        """Return the demand of the workload at time t."""
+        ret = self.phases[0][1]
+        for start, watts in self.phases:
+            if start > t:
+                break
+            ret = watts
+        return ret
+
+    def step(self, t, dt, rng):
+        """Advance the model by dt seconds and return the power drawn."""
+        goal = min(self.cap, self.demand(t))
+        if self.lag > 0:
+            alpha = min(dt / self.lag, 1.0)
+        else:
+            alpha = 1.0
+        self.power += alpha * (goal - self.power)
+        if self.noise:
+            return max(self.power + rng.gauss(0.0, self.noise), 0.0)
+        return self.power
+
+
+class SimulatedSensorManager(object):
+
+    """Implements the SensorManager interface used by the control loop on
+    top of power models.
+
+    models is a dictionary of PowerModel indexed by long RAPL domain names
+    (e.g., package-0, package-0/dram). Domains that are not controlled are
+    reported as disabled, like RAPL domains without power capping."""
+
+    def __init__(self, models, period=1.0, seed=None, history_size=600):
+        self.models = models
+        self.period = period
+        self.rng = random.Random(seed)
+        self.time = 0.0
+        self.energy = {k: 0.0 for k in models}
+        self.history = TelemetryStore(history_size)
+        self.nodename = 'simulated'
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def shortenkey(self, domain):
+        return domain.replace('package-', 'p')
+
+    def do_update(self):
+        self.time += self.period
+        power = dict()
+        for k, model in self.models.items():
+            power[k] = model.step(self.time, self.period, self.rng)
+            self.energy[k] += power[k] * self.period * 1000000.0
+        # like coolr, the total excludes core subdomains
+        rapl = {'energy': {}, 'power': {}, 'powercap': {}}
+        for k in self.models:
+            s = self.shortenkey(k)
+            rapl['energy'][s] = self.energy[k]
+            rapl['power'][s] = power[k]
+            rapl['powercap'][s] = self.models[k].cap
+        rapl['power']['total'] = sum(power[k] for k in power
+                                     if k.find('core') == -1)
+        machine_info = {'energy': rapl, 'temperature': {}, 'time': self.time}
+        for kind in ('energy', 'power', 'powercap'):
+            for k, v in rapl[kind].items():
+                self.history.append((kind, k), self.time, v)
+        return machine_info
+
+    def get_powerlimits(self, refresh=False):
+        return {k: {'curW': m.cap, 'maxW': m.maxW, 'enabled': True}
+                for k, m in self.models.items() if m.controlled}
+
+    def set_powerlimit(self, domain, value):
+        self.models[domain].cap = value
+
+    def set_powerlimits(self, limits):
+        for domain, value in limits.items():
+            self.set_powerlimit(domain, value)
+
+
+def replay(controller, sensor_manager, targets, duration, tolerance=0.05,
+           settle=0.25):
+    """Replay a list of (start time, target watts) through the control loop.
+
+    Runs the controller once per sensor update for duration simulated
+    seconds. Returns a dictionary with the controller cost, as the mean and
+    max wall time spent planning and executing per control tick (in
+    seconds), and a list of metrics for each target:
+        - convergence: time from the target change until the total power
+          stays within tolerance (relative) of the target, None if never.
+        - overshoot: largest excursion past the target, in the direction of
+          the change, in watts.
+        - error: mean absolute error over the last settle fraction of the
+          target interval, in watts."""
+    targets = sorted(targets)
+    trace = []
+    costs = []
+    while sensor_manager.time < duration:
+        info = sensor_manager.do_update()
+        t = info['time']
+        target = targets[0][1]
+        for start, watts in targets:
+            if start < t:
+                target = watts
+        begin = timeit.default_timer()
+        plan = controller.planify(target, info)
+        if plan:
+            controller.execute(plan)
+            controller.update(plan)
+        costs.append(timeit.default_timer() - begin)
+        trace.append((t, target, info['energy']['power']['total']))
+
+    metrics = []
+    for i, (start, target) in enumerate(targets):
+        end = targets[i+1][0] if i + 1 < len(targets) else duration
+        seg = [(ts, p) for ts, w, p in trace if start < ts <= end]
+        if not seg:
+            continue
+        before = [p for ts, w, p in trace if ts <= start]
+        initial = before[-1] if before else seg[0][1]
+        direction = 1.0 if target >= initial else -1.0
+        bound = tolerance * target
+        convergence = None
+        for j in range(len(seg)):
+            if all(abs(p - target) <= bound for ts, p in seg[j:]):
+                convergence = seg[j][0] - start
+                break
+        overshoot = max([direction * (p - target) for ts, p in seg] + [0.0])
+        tail = seg[int(len(seg) * (1.0 - settle)):] or seg[-1:]
+        error = sum(abs(p - target) for ts, p in tail) / len(tail)
+        metrics.append({'target': target,
+                        'start': start,
+                        'convergence': convergence,
+                        'overshoot': overshoot,
+                        'error': error,
+                        })
+    cost = {'mean': sum(costs) / len(costs) if costs else 0.0,
+            'max': max(costs) if costs else 0.0}
+    return {'targets': metrics, 'cost': cost}
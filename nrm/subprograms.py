@@ -8,16 +8,27 @@
 # SPDX-License-Identifier: BSD-3-Clause
 ###############################################################################
 
-"""Various clients for system utilities."""
+"""Various clients for system utilities.
+
+Commands changing the system state can take seconds to complete (e.g.,
+starting a singularity instance), so the clients run them on a bounded pool
+of threads and return tornado futures, keeping the daemon event loop
+responsive in the meantime. Topology queries are answered from an
+in-memory model instead."""
 import collections
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import xml.etree.ElementTree
+from tornado.concurrent import run_on_executor
 import tornado.process as process
 import subprocess
 
 logger = logging.getLogger('nrm')
 resources = collections.namedtuple("Resources", ["cpus", "mems"])
 
+# shared by all the clients, unless given their own.
+default_executor = ThreadPoolExecutor(max_workers=4)
+
 
 def logpopen(p, args, stdout, stderr):
     """log popen cmd."""
@@ -28,8 +39,11 @@ def logpopen(p, args, stdout, stderr):
 
 
 def bitmask2list(mask):
-    """Convert a bitmask to the list of power of 2 set to 1."""
-    i = int(mask or '0x0', base=16)
+    """Convert a bitmask to the list of power of 2 set to 1.
+
+    Accepts the hwloc format for large masks, a comma separated list of 32
+    bits words."""
+    i = int((mask or '0x0').replace(',0x', ''), base=16)
     ret = []
     for j in range(i.bit_length()):
         m = 1 << j
@@ -50,15 +64,17 @@ class NodeOSClient(object):
 
     """Client to argo_nodeos_config."""
 
-    def __init__(self, argo_nodeos_config="argo_nodeos_config"):
+    def __init__(self, argo_nodeos_config="argo_nodeos_config",
+                 executor=None):
         """Load client configuration."""
         self.prefix = argo_nodeos_config
+        self.executor = executor or default_executor
 
     def getavailable(self):
         """Gather available resources."""
         args = [self.prefix, "--show_available_resources=shared:false"]
         p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, close_fds=True)
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
         # parse the format: first line is threads, then a list as multiline,
@@ -75,6 +91,7 @@ class NodeOSClient(object):
             mems.extend(l.split())
         return resources([int(x) for x in cpus], [int(x) for x in mems])
 
+    @run_on_executor
     def create(self, name, params):
         """Create container, according to params."""
         args = [self.prefix]
@@ -85,15 +102,17 @@ class NodeOSClient(object):
         args.append(cmd)
         try:
             p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
+                                 stderr=subprocess.PIPE, close_fds=True)
         except OSError:
             logger.error("Could not run argo_nodeos_config. Use either the"
                          "--argo_nodeos_config nrmd option or the"
                          " ARGO_NODEOS_CONFIG env var. to configure it.")
+            raise
 
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
 
+    @run_on_executor
     def attach(self, name, pid):
         """Attach a pid to a container."""
         args = [self.prefix]
@@ -102,10 +121,11 @@ class NodeOSClient(object):
         cmd += ' pids:[{0}]'.format(pid)
         args.append(cmd)
         p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, close_fds=True)
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
 
+    @run_on_executor
     def delete(self, name, kill=False):
         """Destroy container."""
         # destroy container
@@ -116,7 +136,7 @@ class NodeOSClient(object):
             cmd += ' kill_content:true'
         args.append(cmd)
         p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, close_fds=True)
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
 
@@ -145,10 +165,12 @@ class SingularityClient(object):
 
     """Client to singularity."""
 
-    def __init__(self, singularity_path="singularity"):
+    def __init__(self, singularity_path="singularity", executor=None):
         """Load client configuration."""
         self.prefix = singularity_path
+        self.executor = executor or default_executor
 
+    @run_on_executor
     def instance_start(self, instance_name, container_image, bind_list=[]):
         """Start a named instance of a container image.
 
@@ -161,7 +183,7 @@ class SingularityClient(object):
         args.extend([container_image, instance_name])
         logger.error("launching singularity command: %s", args)
         p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, close_fds=True)
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
 
@@ -179,6 +201,7 @@ class SingularityClient(object):
                                   close_fds=True,
                                   cwd=environ['PWD'])
 
+    @run_on_executor
     def instance_stop(self, instance_name, kill=False):
         """Stop an instance and kill everything in it."""
 
@@ -188,7 +211,7 @@ class SingularityClient(object):
             args.append("--force")
         args.append(instance_name)
         p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, close_fds=True)
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
 
@@ -217,33 +240,153 @@ class ChrtClient(object):
         return args
 
 
+class TopologyObject(object):
+
+    """An object of the hwloc topology tree."""
+
+    def __init__(self, type, os_index, cpuset, parent=None):
+        self.type = type
+        self.os_index = os_index
+        self.cpuset = cpuset
+        self.parent = parent
+        self.children = []
+
+
+class Topology(object):
+
+    """In-memory model of the node topology, built from an hwloc XML export.
+
+    Only objects with a cpuset are kept (I/O objects are not). cpusets are
+    frozensets of PU os indexes."""
+
+    def __init__(self, xmlroot):
+        self.root = None
+        self.numanodes = []
+        self.pus = []
+        for elem in xmlroot.findall('object'):
+            self.root = self._parse(elem, None)
+        assert self.root is not None
+
+    def _parse(self, elem, parent):
+        attrib = elem.attrib
+        obj = TopologyObject(attrib['type'], int(attrib.get('os_index', -1)),
+                             frozenset(bitmask2list(attrib['cpuset'])),
+                             parent)
+        if obj.type == 'NUMANode':
+            self.numanodes.append(obj)
+        elif obj.type == 'PU':
+            self.pus.append(obj)
+        for child in elem.findall('object'):
+            if 'cpuset' in child.attrib:
+                obj.children.append(self._parse(child, obj))
+        return obj
+
+    def objects(self, *types):
+        """Return the objects of the given types, in tree order."""
+        ret = []
+        stack = [self.root]
+        while stack:
+            obj = stack.pop()
+            if obj.type in types:
+                ret.append(obj)
+            stack.extend(reversed(obj.children))
+        return ret
+
+    def resources(self):
+        """Return all the cpus and mems."""
+        mems = sorted(n.os_index for n in self.numanodes)
+        # if there's only one memory node, hwloc doesn't list it
+        return resources(sorted(pu.os_index for pu in self.pus), mems or [0])
+
+    def mems(self, cpus):
+        """Return the NUMA nodes local to a set of cpus."""
+        ret = sorted(n.os_index for n in self.numanodes if n.cpuset & cpus)
+        return ret or [0]
+
+    def cpuchildren(self, obj):
+        """Return the children of an object that split its cpuset."""
+        # with hwloc 2, NUMA nodes are memory children of the objects they
+        # are local to, and do not split the cpuset further.
+        children = [c for c in obj.children if c.type != 'NUMANode']
+        return children or obj.children
+
+    def _distrib(self, objs, restrict, n, ret):
+        cpusets = [o.cpuset & restrict for o in objs]
+        total = sum(len(c) for c in cpusets)
+        givenweight = 0
+        for obj, cpuset in zip(objs, cpusets):
+            weight = len(cpuset)
+            if not weight:
+                continue
+            # a share proportional to the object weight, rounded up like
+            # hwloc does, the next objects get a bit less.
+            chunk = (((givenweight + weight) * n + total - 1) // total -
+                     (givenweight * n + total - 1) // total)
+            children = self.cpuchildren(obj)
+            if chunk <= 1 or not children:
+                ret.extend([cpuset] * chunk)
+            else:
+                self._distrib(children, restrict, chunk, ret)
+            givenweight += weight
+
+    def distrib(self, n, restrict=None):
+        """Distribute n processes across the hierarchy, like hwloc-distrib.
+
+        Returns one cpuset per process, possibly restricted to a set of
+        cpus."""
+        if restrict is None:
+            restrict = self.root.cpuset
+        ret = []
+        self._distrib([self.root], frozenset(restrict), n, ret)
+        return ret
+
+
 class HwlocClient(object):
 
-    """Client to hwloc binaries."""
+    """Client to hwloc binaries.
+
+    The topology is exported once and kept in memory, it is only reloaded
+    when the set of online cpus changes."""
+
+    online = '/sys/devices/system/cpu/online'
 
-    def __init__(self, hwloc="hwloc"):
+    def __init__(self, hwloc="hwloc", executor=None):
         """Load configuration."""
         self.prefix = hwloc
+        self.executor = executor or default_executor
+        self.topology = None
+        self.onlinecpus = None
 
-    def info(self):
-        """Return list of all cpus and mems."""
+    def _online(self):
+        try:
+            with open(self.online) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def load(self):
+        """Export the topology from hwloc-ls and return its model."""
         cmd = self.prefix + "-ls"
         args = [cmd, '--whole-system', '--output-format', 'xml']
         p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+                             stderr=subprocess.PIPE, close_fds=True)
         stdout, stderr = p.communicate()
         logpopen(p, args, stdout, stderr)
-        xmlroot = xml.etree.ElementTree.fromstring(stdout)
-        ret = resources([], [])
-        for obj in xmlroot.iter('object'):
-            if obj.attrib['type'] == "NUMANode":
-                ret.mems.append(int(obj.attrib['os_index']))
-            if obj.attrib['type'] == "PU":
-                ret.cpus.append(int(obj.attrib['os_index']))
-        # if there's only one memory node, hwloc doesn't list it
-        if not ret.mems:
-            ret.mems.append(0)
-        return ret
+        return Topology(xml.etree.ElementTree.fromstring(stdout))
+
+    def gettopology(self):
+        """Return the topology model, reloading it after cpu hotplug."""
+        online = self._online()
+        if self.topology is None or online != self.onlinecpus:
+            if self.topology is not None:
+                logger.info("online cpus changed, reloading topology")
+            self.topology = self.load()
+            self.onlinecpus = online
+        return self.topology
+
+    def info(self):
+        """Return list of all cpus and mems."""
+        return self.gettopology().resources()
 
     def all2fake(self, resources):
         """Convert resource description of the system into fake topology.
@@ -257,57 +400,17 @@ class HwlocClient(object):
         pu = cpus // mems
         return "numa: %s pu:%s".format(mems, pu)
 
-    def distrib(self, numprocs, restrict=None, fake=None):
-        """Distribute numprocs across the hierarchy."""
-        # The original command only reports back cpusets. We do better, by
-        # reporting the mems that go with it. This requires some magic, using
-        # hwloc-ls to find the numa node associated with a cpuset reported by
-        # distrib
-        allresources = self.info()
-        cmd = [self.prefix + "-distrib"]
-        if fake:
-            cmd.extend(['-i', self.all2fake(fake)])
-        args = cmd + ["--whole-system", "--taskset", str(numprocs)]
-        if restrict:
-            mask = list2bitmask(restrict.cpus)
-            args.extend(['--restrict', mask])
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        logpopen(p, args, stdout, stderr)
-        cpusets = stdout.splitlines()
-        dret = {}
-        for c in cpusets:
-            dret[c] = resources(bitmask2list(c), [])
-
-        # list all resources, and display cpusets too
-        # this will give us the memories associated with each cpuset.
-        cmd = [self.prefix + "-ls"]
-        if fake:
-            cmd.extend(['-i', self.all2fake(fake)])
-        args = cmd + ["--whole-system", "-c", "--taskset"]
-        p = subprocess.Popen(args, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        logpopen(p, args, stdout, stderr)
-        lines = stdout.splitlines()
-        curmem = allresources.mems
-        for l in lines:
-            pos = l.find('cpuset=')
-            if pos != -1:
-                c = l[l.find('cpuset='):].lstrip('cpuset=')
-                numa = l.find('NUMANode')
-                cset = set(bitmask2list(c))
-                if numa != -1:
-                    uid = int(l.split()[1].lstrip('L#'))
-                    curmem = [uid]
-                for mask in dret:
-                    cs = set(bitmask2list(mask))
-                    if cset.issubset(cs):
-                        dret[mask].mems.extend(curmem)
-        # At this point, we have valid cpusets, but the mems associated are not
-        # restricted, and not necessarily the right amount. We need to:
-        #    - remove memories for the restricted set
-        #    - split each (cpuset, mems) that is too big into a list of memset
-        #    choices of the right size
-        return dret.values()
+    def distrib(self, numprocs, restrict=None):
+        """Distribute numprocs across the hierarchy.
+
+        Returns the list of distinct (cpus, mems) resources the processes
+        are distributed on. The mems of each resource are the NUMA nodes
+        local to its cpus."""
+        topology = self.gettopology()
+        cpus = restrict.cpus if restrict else None
+        ret = []
+        for cpuset in topology.distrib(numprocs, cpus):
+            r = resources(sorted(cpuset), topology.mems(cpuset))
+            if r not in ret:
+                ret.append(r)
+        return ret
@@ -0,0 +1,121 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Telemetry Module:
+    provide bounded in-memory history of the values measured by the daemon.
+
+    Each time series is stored in a preallocated ring buffer backed by numpy
+    arrays, so appending a sample is O(1) and memory use does not grow with
+    the lifetime of the daemon. Windowed queries (mean, max, percentiles over
+    the last N seconds) work directly on the arrays.
+"""
+from __future__ import print_function
+import numpy as np
+
+
+class RingBuffer(object):
+
+    """Fixed-capacity time series of (time, value) samples."""
+
+    def __init__(self, capacity):
+        assert capacity > 0
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = np.zeros(capacity)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time, value):
+        """Add a sample, overwriting the oldest one if the buffer is full."""
+        i = self.count % self.capacity
+        self.times[i] = time
+        self.values[i] = value
+        # only advance once the sample is fully written, so that readers in
+        # other threads never see a half-written slot.
+        self.count += 1
+
+    def latest(self):
+        """Return the most recent (time, value) sample, or None."""
+        if not self.count:
+            return None
+        i = (self.count - 1) % self.capacity
+        return (self.times[i], self.values[i])
+
+    def ordered(self):
+        """Return (times, values) arrays in chronological order.
+
+        Views are returned until the buffer wraps around, copies after."""
+        count = self.count
+        if count <= self.capacity:
+            return (self.times[:count], self.values[:count])
+        i = count % self.capacity
+        return (np.concatenate((self.times[i:], self.times[:i])),
+                np.concatenate((self.values[i:], self.values[:i])))
+
+    def window(self, seconds=None, now=None):
+        """Return the values sampled in the last seconds.
+
+        The window ends at now, or at the most recent sample if now is
+        None. All stored values are returned if seconds is None."""
+        times, values = self.ordered()
+        if seconds is None or not len(times):
+            return values
+        if now is None:
+            now = times[-1]
+        start = np.searchsorted(times, now - seconds, side='left')
+        end = np.searchsorted(times, now, side='right')
+        return values[start:end]
+
+    def mean(self, seconds=None, now=None):
+        w = self.window(seconds, now)
+        return float(np.mean(w)) if len(w) else None
+
+    def max(self, seconds=None, now=None):
+        w = self.window(seconds, now)
+        return float(np.max(w)) if len(w) else None
+
+    def min(self, seconds=None, now=None):
+        w = self.window(seconds, now)
+        return float(np.min(w)) if len(w) else None
+
+    def percentile(self, q, seconds=None, now=None):
+        w = self.window(seconds, now)
+        return float(np.percentile(w, q)) if len(w) else None
+
+
+class TelemetryStore(object):
+
+    """Collection of ring buffers, indexed by tuple keys.
+
+    Keys follow the layout of the sensor data, e.g. ('power', 'p0') or
+    ('temperature', 'p0', 'pkg')."""
+
+    def __init__(self, capacity=600):
+        self.capacity = capacity
+        self.series = dict()
+
+    def append(self, key, time, value):
+        """Record a sample, creating the time series if needed."""
+        try:
+            ring = self.series[key]
+        except KeyError:
+            ring = RingBuffer(self.capacity)
+            self.series[key] = ring
+        ring.append(time, value)
+
+    def get(self, *key):
+        """Return the ring buffer for a key, or None if it was never
+        recorded."""
+        return self.series.get(key)
+
+    def keys(self):
+        return self.series.keys()
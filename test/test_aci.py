@@ -33,3 +33,28 @@ def test_enabled_feature(manifest_base_data):
     data["app"]["perfwrapper"] = "enabled"
     manifest = nrm.aci.ImageManifest(data)
     assert manifest.is_feature_enabled("perfwrapper")
+
+
+def test_manifest_cache(tmpdir):
+    """Ensure manifests are parsed once, until their file changes."""
+    path = tmpdir.join("manifest.yml")
+    path.write("name: basic\n")
+    cache = nrm.aci.ManifestCache(dict, size=1)
+    first = cache.load(str(path))
+    assert first == {'name': 'basic'}
+    assert cache.load(str(path)) is first
+    path.write("name: modified\n")
+    assert cache.load(str(path)) == {'name': 'modified'}
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_manifest_cache_eviction(tmpdir):
+    """Ensure the least recently used manifests are evicted."""
+    paths = []
+    for name in ['a', 'b', 'c']:
+        paths.append(str(tmpdir.join(name + ".yml")))
+        tmpdir.join(name + ".yml").write("name: %s\n" % name)
+    cache = nrm.aci.ManifestCache(dict, size=2)
+    for p in paths[:2] + paths[:1] + paths[2:]:
+        cache.load(p)
+    assert list(cache.manifests) == [paths[0], paths[2]]
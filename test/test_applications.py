@@ -0,0 +1,40 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Applications module."""
+import nrm
+import nrm.applications
+import nrm.messaging
+import pytest
+
+
+@pytest.fixture
+def application():
+    """Fixture for an application registered at time 10."""
+    return nrm.applications.Application('a', 'c', 0, False, None, 10.0)
+
+
+def progress(payload):
+    return nrm.messaging.message('downstreamEvent',
+                                 {'tag': 'progress', 'payload': payload,
+                                  'application_uuid': 'a'})
+
+
+def test_report_summary(application):
+    for i in range(4):
+        application.update_progress(progress(i))
+    assert application.progress == 6
+    summary = application.summarize(12.0)
+    assert summary.keys() == ['progress']
+    assert summary['progress'] == {'payload': 6.0, 'count': 4, 'rate': 3.0,
+                                   'window': 2.0}
+    assert application.summarize(13.0) == {}
+    application.update_progress(progress(1))
+    assert application.summarize(14.0)['progress']['window'] == 1.0
@@ -23,6 +23,25 @@ def rapl_reader():
     return rr
 
 
+@pytest.fixture
+def fake_rapl_reader(tmpdir, monkeypatch):
+    """Fixture for a rapl reader on top of a fake sysfs tree."""
+    pkg = tmpdir.mkdir("intel-rapl:0")
+    dram = pkg.mkdir("intel-rapl:0:0")
+    for d, name in [(pkg, "package-0"), (dram, "dram")]:
+        d.join("name").write(name + "\n")
+        d.join("energy_uj").write("1000000\n")
+        d.join("max_energy_range_uj").write("262143328850\n")
+        d.join("constraint_0_power_limit_uw").write("100000000\n")
+        d.join("constraint_0_max_power_uw").write("150000000\n")
+        d.join("enabled").write("1\n")
+    monkeypatch.setattr(nrm.coolr.clr_rapl.rapl_reader, "rapldir",
+                        str(tmpdir))
+    rr = nrm.coolr.clr_rapl.rapl_reader()
+    rr.fake_dirs = {"package-0": pkg, "package-0/dram": dram}
+    return rr
+
+
 def test_read_powerdomains(rapl_reader):
     """Ensure we can read the power domains."""
     assert rapl_reader.get_powerdomains()
@@ -57,3 +76,58 @@ def test_sample(rapl_reader):
         assert rapl_reader.sample(accflag=True)
     rapl_reader.stop_energy_counter()
     assert rapl_reader.total_energy_json()
+
+
+def test_fake_sample(fake_rapl_reader):
+    """Ensure sampling re-reads the energy counters in place."""
+    fake_rapl_reader.fake_dirs["package-0"].join("energy_uj").write(
+            "3000000\n")
+    data = fake_rapl_reader.sample(accflag=True)
+    assert data['energy']['p0'] == 3000000
+    assert data['energy']['p0/dram'] == 1000000
+    assert data['powercap']['p0'] == 100.0
+    assert data['power']['p0'] > 0
+
+
+def test_fake_read_errors(fake_rapl_reader):
+    """Ensure unreadable power limit attributes are reported."""
+    d = fake_rapl_reader.fake_dirs["package-0/dram"]
+    d.join("constraint_0_max_power_uw").write("")
+    data = fake_rapl_reader.get_powerlimits()
+    assert data['package-0/dram']['maxW'] < 0
+    assert str(d.join("constraint_0_max_power_uw")) in \
+        fake_rapl_reader.read_errors
+
+
+def test_fake_powerlimit_cache(fake_rapl_reader):
+    """Ensure power limits are cached until they are written."""
+    fake_rapl_reader.powerlimit_period = None
+    limit = fake_rapl_reader.fake_dirs["package-0"].join(
+            "constraint_0_power_limit_uw")
+    assert fake_rapl_reader.get_powerlimits()['package-0']['curW'] == 100.0
+    limit.write("90000000\n")
+    assert fake_rapl_reader.sample()['powercap']['p0'] == 100.0
+    fake_rapl_reader.set_powerlimit(80, 'package-0')
+    assert fake_rapl_reader.get_powerlimits()['package-0']['curW'] == 80.0
+
+
+def test_fake_powerlimit_write(fake_rapl_reader):
+    """Ensure a power limit write updates the cache in place."""
+    before = fake_rapl_reader.get_powerlimits()
+    fake_rapl_reader.set_powerlimit(80, 'package-0')
+    after = fake_rapl_reader.get_powerlimits()
+    assert after is before
+    assert after['package-0']['curW'] == 80.0
+    assert after['package-0/dram']['curW'] == 100.0
+
+
+def test_fake_unreadable_energy(fake_rapl_reader):
+    """Ensure an energy counter that can not be opened reads as -1."""
+    d = fake_rapl_reader.fake_dirs["package-0/dram"]
+    d.join("energy_uj").remove()
+    energy = d.mkdir("energy_uj")
+    rr = nrm.coolr.clr_rapl.rapl_reader()
+    assert str(energy) in rr.read_errors
+    assert rr.readenergy()['package-0/dram'] == -1
+    rr.close()
+    assert not rr.sysfs.files
@@ -0,0 +1,48 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Coolr sysfs module."""
+import nrm
+import nrm.coolr
+import nrm.coolr.clr_sysfs
+import pytest
+
+
+@pytest.fixture
+def sysfs_reader():
+    """Fixture for a regular sysfs reader."""
+    return nrm.coolr.clr_sysfs.sysfs_reader()
+
+
+def test_reread_after_update(sysfs_reader, tmpdir):
+    """Ensure a registered file reflects later updates."""
+    f = tmpdir.join("energy_uj")
+    f.write("1234\n")
+    fn = sysfs_reader.register(str(f))
+    assert sysfs_reader.readint(fn) == 1234
+    f.write("56\n")
+    assert sysfs_reader.readint(fn) == 56
+    sysfs_reader.close()
+    assert not sysfs_reader.registered(fn)
+
+
+def test_missing_file(sysfs_reader, tmpdir):
+    """Ensure opening a missing attribute fails explicitly."""
+    with pytest.raises(IOError):
+        sysfs_reader.register(str(tmpdir.join("missing")))
+
+
+def test_empty_read(sysfs_reader, tmpdir):
+    """Ensure empty reads are reported instead of returning garbage."""
+    f = tmpdir.join("enabled")
+    f.write("")
+    fn = sysfs_reader.register(str(f))
+    with pytest.raises(IOError):
+        sysfs_reader.readint(fn)
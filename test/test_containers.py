@@ -0,0 +1,270 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Containers module."""
+import nrm
+import nrm.containers
+import nrm.resources
+import nrm.subprograms
+import pytest
+from test_subprograms import TOPOLOGY
+from tornado import gen, ioloop
+import xml.etree.ElementTree
+
+
+class _process(object):
+    pid = 0
+
+    def __init__(self):
+        _process.pid += 1
+        self.pid = _process.pid
+
+
+class _runtime(nrm.containers.ContainerRuntime):
+
+    """Runtime taking a while to create containers."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created = []
+        self.running = 0
+        self.max_running = 0
+        self.deleted = []
+
+    @gen.coroutine
+    def create(self, container, downstream_uri):
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        yield gen.sleep(0.05)
+        self.running -= 1
+        if self.fail:
+            raise RuntimeError("runtime failure")
+        self.created.append(container.uuid)
+
+    def execute(self, container_uuid, args, environ):
+        return _process()
+
+    def delete(self, container_uuid, kill=False):
+        self.deleted.append(container_uuid)
+        return nrm.containers.DummyRuntime().done()
+
+
+class _slow_teardown_runtime(_runtime):
+
+    """Runtime taking a while to delete containers."""
+
+    @gen.coroutine
+    def delete(self, container_uuid, kill=False):
+        self.running += 1
+        self.max_running = max(self.running, self.max_running)
+        yield gen.sleep(0.05)
+        self.running -= 1
+        self.deleted.append(container_uuid)
+
+
+class _pooled_runtime(_runtime):
+
+    """Runtime whose instances only depend on the manifest name."""
+
+    def pool_key(self, container):
+        return container.manifest['name']
+
+
+class _manifest(dict):
+
+    """Manifest with only a cpu slice and no features."""
+
+    def __init__(self, data):
+        super(_manifest, self).__init__(data)
+        self.app = data['app']
+
+    def is_feature_enabled(self, feature):
+        return False
+
+
+@pytest.fixture
+def resource_manager(monkeypatch):
+    """Fixture for a resource manager on a 8 cpus node."""
+    monkeypatch.setattr(nrm.containers, 'ImageManifest', _manifest)
+    topology = nrm.subprograms.Topology(
+            xml.etree.ElementTree.fromstring(TOPOLOGY))
+    monkeypatch.setattr(nrm.subprograms.HwlocClient, 'load',
+                        lambda self: topology)
+    return nrm.resources.ResourceManager('hwloc')
+
+
+def request(uuid, priority=0, manifest='examples/basic.yml'):
+    return {'manifest': manifest, 'file': 'true', 'args': [],
+            'environ': {}, 'uuid': uuid, 'clientid': 'client',
+            'priority': priority}
+
+
+def run_all(cm, requests):
+    @gen.coroutine
+    def run():
+        ret = yield [cm.create(r) for r in requests]
+        raise gen.Return(ret)
+    return ioloop.IOLoop.current().run_sync(run)
+
+
+def test_concurrent_launches(resource_manager):
+    runtime = _runtime()
+    cm = nrm.containers.ContainerManager(runtime, resource_manager,
+                                         max_launches=2)
+    run_all(cm, [request(str(i)) for i in range(4)])
+    assert runtime.max_running == 2
+    assert sorted(runtime.created) == ['0', '1', '2', '3']
+    cpus = [set(c.resources.cpus) for c in cm.containers.values()]
+    assert set.union(*cpus) == set(range(8))
+    assert cm.launch_stats()['count'] == 4
+
+
+def test_shared_creation(resource_manager):
+    runtime = _runtime()
+    cm = nrm.containers.ContainerManager(runtime, resource_manager)
+    run_all(cm, [request('c')] * 3)
+    assert runtime.created == ['c']
+    assert len(cm.containers['c'].processes) == 3
+
+
+def test_failed_creation(resource_manager):
+    cm = nrm.containers.ContainerManager(_runtime(fail=True),
+                                         resource_manager)
+    with pytest.raises(RuntimeError):
+        run_all(cm, [request('c')] * 2)
+    assert not cm.containers
+    assert not cm.pending
+    assert sorted(resource_manager.available.cpus) == range(8)
+
+
+def test_admission_queue(resource_manager):
+    cm = nrm.containers.ContainerManager(_runtime(), resource_manager)
+
+    @gen.coroutine
+    def run():
+        # the node holds four 2 cpus slices, the fifth one waits
+        first = [cm.create(request(str(i))) for i in range(4)]
+        last = cm.create(request('4'))
+        yield first
+        assert not last.done()
+        assert cm.queue_stats()['depth'] == 1
+        yield cm.delete('0')
+        pid, container = yield last
+        assert sorted(container.resources.cpus) == [0, 1]
+    ioloop.IOLoop.current().run_sync(run)
+    assert cm.queue_stats()['depth'] == 0
+    assert cm.queue_stats()['admitted'] == 5
+
+
+def test_admission_priority(resource_manager):
+    cm = nrm.containers.ContainerManager(_runtime(), resource_manager,
+                                         admission='priority')
+
+    @gen.coroutine
+    def run():
+        yield [cm.create(request(str(i))) for i in range(4)]
+        low = cm.create(request('low', priority=0))
+        high = cm.create(request('high', priority=5))
+        yield cm.delete('0')
+        yield high
+        assert not low.done()
+        yield cm.delete('1')
+        yield low
+    ioloop.IOLoop.current().run_sync(run)
+    assert sorted(cm.containers) == ['2', '3', 'high', 'low']
+
+
+def test_admission_kill(resource_manager):
+    cm = nrm.containers.ContainerManager(_runtime(), resource_manager)
+
+    @gen.coroutine
+    def run():
+        yield [cm.create(request(str(i))) for i in range(4)]
+        killed = cm.create(request('killed'))
+        last = cm.create(request('last'))
+        assert cm.kill('killed')
+        with pytest.raises(RuntimeError):
+            yield killed
+        assert cm.queue_stats()['depth'] == 1
+        yield cm.delete('0')
+        yield last
+    ioloop.IOLoop.current().run_sync(run)
+    assert 'killed' not in cm.containers
+    assert not cm.queued
+
+
+def test_admission_too_large(resource_manager, tmpdir):
+    manifest = tmpdir.join('large.yml')
+    manifest.write("app:\n  slice:\n    cpus: 16\n    mems: 1\n")
+    cm = nrm.containers.ContainerManager(_runtime(), resource_manager)
+    with pytest.raises(ValueError):
+        run_all(cm, [request('c', manifest=str(manifest))])
+    manifest.write("app:\n  slice:\n    cpus: 1\n    mems: 4\n")
+    with pytest.raises(ValueError):
+        run_all(cm, [request('d', manifest=str(manifest))])
+    assert not cm.queue
+
+
+def test_instance_pool(resource_manager):
+    runtime = _pooled_runtime()
+    cm = nrm.containers.ContainerManager(runtime, resource_manager,
+                                         pool_size=2)
+
+    @gen.coroutine
+    def run():
+        yield cm.create(request('a'))
+        # the first container of an image fills the pool
+        yield gen.sleep(0.1)
+        assert len(cm.pool.ready['basic']) == 2
+        yield cm.create(request('b'))
+        assert cm.instances['b'] in runtime.created
+        yield gen.sleep(0.1)
+    ioloop.IOLoop.current().run_sync(run)
+    assert len(runtime.created) == 4
+    assert len(cm.pool.ready['basic']) == 2
+    instance = cm.instances['b']
+    cm.delete('b')
+    assert runtime.deleted == [instance]
+    cm.pool.drain()
+    assert len(runtime.deleted) == 3
+    assert not cm.pool.ready
+
+
+def test_bounded_teardowns(resource_manager):
+    runtime = _slow_teardown_runtime()
+    cm = nrm.containers.ContainerManager(runtime, resource_manager,
+                                         max_launches=1, max_teardowns=2)
+    run_all(cm, [request(str(i)) for i in range(4)])
+
+    @gen.coroutine
+    def run():
+        yield [cm.delete(str(i)) for i in range(4)]
+    ioloop.IOLoop.current().run_sync(run)
+    assert runtime.max_running == 2
+    assert sorted(runtime.deleted) == ['0', '1', '2', '3']
+    assert not cm.containers
+
+
+def test_instance_pool_bounds(resource_manager):
+    runtime = _pooled_runtime()
+    cm = nrm.containers.ContainerManager(runtime, resource_manager,
+                                         pool_size=2)
+
+    @gen.coroutine
+    def run():
+        # launches at the same time do not fill the pool twice
+        yield [cm.create(request(str(i))) for i in range(3)]
+        assert len(cm.pool.warming['basic']) == 2
+        # instances being created are deleted once ready, drain waits
+        yield cm.pool.drain()
+    ioloop.IOLoop.current().run_sync(run)
+    assert len(runtime.created) == 5
+    assert len(runtime.deleted) == 2
+    assert not cm.pool.ready and not cm.pool.warming['basic']
@@ -0,0 +1,110 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Controller module."""
+import nrm
+import nrm.controller
+import nrm.telemetry
+import pytest
+
+
+class _sensor_manager(object):
+    """Two packages drawing as much power as their cap allows."""
+
+    def __init__(self, demand=150.0):
+        self.demand = {'package-0': demand, 'package-1': demand}
+        self.limits = {'package-0': 100.0, 'package-1': 100.0}
+        self.history = nrm.telemetry.TelemetryStore()
+        self.time = 0.0
+
+    def get_powerlimits(self):
+        return {k: {'curW': v, 'maxW': 200.0, 'enabled': True}
+                for k, v in self.limits.items()}
+
+    def set_powerlimits(self, limits):
+        self.limits.update(limits)
+
+    def do_update(self):
+        self.time += 1.0
+        power = {k.replace('package-', 'p'): min(v, self.demand[k])
+                 for k, v in self.limits.items()}
+        for k, v in power.items():
+            self.history.append(('power', k), self.time, v)
+        power['total'] = sum(power.values())
+        return {'energy': {'power': power}, 'time': self.time}
+
+
+@pytest.fixture
+def sensor_manager():
+    return _sensor_manager()
+
+
+def run_loop(controller, sm, target, ticks):
+    for i in range(ticks):
+        plan = controller.planify(target, sm.do_update())
+        controller.execute(plan)
+        controller.update(plan)
+    return sm.do_update()['energy']['power']['total']
+
+
+@pytest.mark.parametrize("engine", nrm.controller.control_engines.keys())
+def test_engines_converge(sensor_manager, engine):
+    """Ensure every engine reaches the target in a few ticks."""
+    pa = nrm.controller.PowerActuator(
+            sensor_manager, nrm.controller.control_engines[engine]())
+    controller = nrm.controller.Controller([pa])
+    assert abs(run_loop(controller, sensor_manager, 150.0, 20) - 150.0) < 1.0
+    assert abs(run_loop(controller, sensor_manager, 250.0, 20) - 250.0) < 1.0
+
+
+def test_no_action_without_new_sample(sensor_manager):
+    """Ensure stale measurements don't move the caps again."""
+    pa = nrm.controller.PowerActuator(
+            sensor_manager, nrm.controller.ProportionalStepEngine())
+    controller = nrm.controller.Controller([pa])
+    info = sensor_manager.do_update()
+    assert controller.planify(150.0, info)
+    assert not controller.planify(150.0, info)
+
+
+def test_caps_within_limits(sensor_manager):
+    pa = nrm.controller.PowerActuator(
+            sensor_manager, nrm.controller.ProportionalStepEngine())
+    controller = nrm.controller.Controller([pa])
+    run_loop(controller, sensor_manager, 1000.0, 20)
+    assert sensor_manager.limits['package-0'] == 200.0
+    run_loop(controller, sensor_manager, 0.0, 50)
+    assert 1.0 <= sensor_manager.limits['package-0'] < 1.5
+
+
+def test_imbalanced_packages(sensor_manager):
+    """Ensure an idle package gives its budget to a busy one."""
+    sensor_manager.demand['package-1'] = 40.0
+    pa = nrm.controller.PowerActuator(sensor_manager)
+    controller = nrm.controller.Controller([pa])
+    assert abs(run_loop(controller, sensor_manager, 190.0, 20) - 190.0) < 1.0
+    assert sensor_manager.limits['package-0'] >= 149.0
+
+
+def test_allocator_bounds():
+    """Ensure shares respect domain bounds and the overall budget."""
+    allocator = nrm.controller.BudgetAllocator()
+    low = {'a': 10.0, 'b': 10.0}
+    high = {'a': 100.0, 'b': 100.0}
+    shares = allocator.allocate(150.0, {'a': 90.0, 'b': 20.0}, low, high)
+    assert shares['a'] <= 100.0
+    assert abs(sum(shares.values()) - 150.0) < 1e-6
+    shares = allocator.allocate(150.0, {'a': 60.0, 'b': 20.0}, low, high,
+                                limited=['a'])
+    assert shares == {'a': 100.0, 'b': 50.0}
+    shares = allocator.allocate(60.0, {'a': 90.0, 'b': 30.0}, low, high)
+    assert shares == {'a': 42.0, 'b': 18.0}
+    shares = allocator.allocate(10.0, {'a': 90.0, 'b': 30.0}, low, high)
+    assert shares == low
@@ -0,0 +1,164 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Daemon module."""
+import collections
+import nrm
+import nrm.containers
+import nrm.daemon
+import nrm.messaging
+import pytest
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+
+class _recorder(object):
+
+    """Stand-in for the message servers, keeping what is sent."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, *args, **kwargs):
+        self.sent.append(kwargs)
+
+
+class _container_manager(object):
+
+    def __init__(self, containers):
+        self.pids = {pid: c for c in containers for pid in c.processes}
+        self.deleted = []
+
+    def delete(self, uuid):
+        self.deleted.append(uuid)
+
+
+class _sensor_manager(object):
+
+    nodename = 'node'
+
+    def __init__(self):
+        self.updates = 0
+
+    def do_update(self):
+        self.updates += 1
+        return sample(10.0)
+
+    def calc_difference(self, start, end):
+        assert end['time'] > start['time']
+        return {'time': end['time'] - start['time']}
+
+
+def sample(t):
+    return {'energy': {'energy': {'p0': t}}, 'temperature': {}, 'time': t}
+
+
+def container(uuid, pid, profile=False):
+    power = {'policy': None, 'profile': None}
+    if profile:
+        power['profile'] = {'start': {'p0': 1.0, 'time': 1.0}}
+    return nrm.containers.Container(uuid, None, None, power, {pid: None},
+                                    {pid: 'client'}, {})
+
+
+@pytest.fixture
+def daemon():
+    config = collections.namedtuple('config', ['history_size'])(10)
+    d = nrm.daemon.Daemon(config)
+    d.upstream_rpc_server = _recorder()
+    d.upstream_pub_server = _recorder()
+    d.sensor_manager = _sensor_manager()
+    d.machine_info = sample(1.0)
+    return d
+
+
+def test_children_failure(daemon):
+    broken = container('a', 1)
+    broken.clientids.clear()
+    daemon.container_manager = _container_manager([broken,
+                                                   container('b', 2)])
+    # exit status 0
+    daemon.do_children([(1, 0, None), (2, 0, None)])
+    # the second child is handled despite the first one
+    assert daemon.container_manager.deleted == ['b']
+    assert [m['tag'] for m in daemon.upstream_pub_server.sent] == ['exit']
+
+
+def test_children_profile(daemon):
+    daemon.container_manager = _container_manager(
+            [container('a', 1, profile=True)])
+    daemon.do_children([(1, 0, None)])
+    # the cached sample is as old as the container, take a new one
+    assert daemon.sensor_manager.updates == 1
+    profile = daemon.upstream_pub_server.sent[0]['profile_data']
+    assert profile['time'] == 9.0
+
+
+def test_run_error(daemon):
+    class _failing(object):
+        @gen.coroutine
+        def create(self, params):
+            raise ValueError("too large")
+    daemon.container_manager = _failing()
+    req = nrm.messaging.message('upstreamReq', {
+        'tag': 'run', 'manifest': 'm.yml', 'path': 'true', 'args': [],
+        'container_uuid': 'c', 'environ': {}})
+    ioloop.IOLoop.current().run_sync(
+            lambda: daemon.do_upstream_receive(req, 'client'))
+    assert daemon.upstream_rpc_server.sent == [
+            {'tag': 'error', 'container_uuid': 'c', 'message': 'too large'}]
+
+
+def test_kill_queued(daemon):
+    class _queued(object):
+        def kill(self, uuid):
+            return True
+    daemon.container_manager = _queued()
+    req = nrm.messaging.message('upstreamReq', {
+        'tag': 'kill', 'container_uuid': 'c'})
+    ioloop.IOLoop.current().run_sync(
+            lambda: daemon.do_upstream_receive(req, 'client'))
+    assert daemon.upstream_rpc_server.sent == [
+            {'tag': 'exit', 'container_uuid': 'c', 'status': '15'}]
+
+
+def test_period_stats(daemon, monkeypatch):
+    ticks = iter([1.0, 2.0, 4.0])
+    monkeypatch.setattr(nrm.daemon.time, 'time', lambda: next(ticks))
+    for i in range(3):
+        daemon.track_period('sensor')
+    assert daemon.period_stats() == {'sensor': {'mean': 1.5, 'max': 2.0}}
+
+
+@pytest.mark.parametrize("drained", [True, False])
+def test_shutdown_drain(daemon, drained):
+    # the shutdown stops the loop, use one of its own
+    loop = ioloop.IOLoop()
+    loop.make_current()
+    deleted = gen.sleep(0.01) if drained else Future()
+
+    class _pooled(object):
+        class pool(object):
+            @staticmethod
+            def drain():
+                return [deleted]
+    daemon.container_manager = _pooled()
+    daemon.sensor_sampler = None
+    daemon.sensor_manager.stop = lambda: None
+    daemon.shutdown_timeout = 0.05
+    start = loop.time()
+    try:
+        loop.run_sync(daemon.do_shutdown)
+    finally:
+        loop.clear_current()
+        loop.close()
+    # the shutdown waits for the drain, up to the timeout
+    assert deleted.done() == drained
+    assert (loop.time() - start >= 0.05) != drained
@@ -0,0 +1,77 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Logs module."""
+import logging
+import nrm
+import nrm.logs
+import Queue
+
+
+class _handler(logging.Handler):
+
+    """Handler keeping the messages of the records."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+def record(msg, args, created):
+    r = logging.LogRecord('nrm.test', logging.INFO, __file__, 0, msg, args,
+                          None)
+    r.created = created
+    return r
+
+
+def test_rate_limit():
+    f = nrm.logs.RateLimitFilter(burst=2, period=1.0)
+    passed = [r.getMessage() for r in
+              [record("tick %d", (i,), 0.1 * i) for i in range(5)] +
+              [record("tick %d", (5,), 1.5)] if f.filter(r)]
+    assert passed == ['tick 0', 'tick 1',
+                      'tick 5 [3 similar messages dropped]']
+    # other messages have their own budget
+    assert f.filter(record("other", (), 0.5))
+
+
+def test_queue_handler():
+    queue = Queue.Queue(2)
+    handler = _handler()
+    logger = logging.getLogger('nrm.test')
+    qh = nrm.logs.QueueHandler(queue)
+    logger.addHandler(qh)
+    try:
+        data = {'a': 1}
+        logger.warning("data: %r", data)
+        # formatted when logged, not when written
+        data['a'] = 2
+        logger.warning("second")
+        logger.warning("dropped, the queue is full")
+        assert qh.dropped == 1
+        listener = nrm.logs.QueueListener(queue, handler)
+        listener.start()
+        listener.stop()
+        assert handler.messages == ["data: {'a': 1}", "second"]
+        # the next record queued reports the drops
+        logger.warning("third")
+    finally:
+        logger.removeHandler(qh)
+    assert queue.get_nowait().getMessage() == "third [1 records dropped]"
+    assert qh.dropped == 0
+
+
+def test_set_levels():
+    nrm.logs.set_levels(['test=debug'])
+    assert logging.getLogger('nrm.test').level == logging.DEBUG
+    logging.getLogger('nrm.test').setLevel(logging.NOTSET)
@@ -11,6 +11,9 @@
 """Tests for the Sensor module."""
 import nrm
 import nrm.messaging
+import zmq
+from tornado import gen
+from zmq.eventloop import ioloop
 import pytest
 
 
@@ -134,3 +137,163 @@ def test_down_event_server_callback(downstream_event_client,
     assert dummy_daemon.called
     assert dummy_daemon.msg == dummy_msg
     assert dummy_daemon.client == downstream_event_client.uuid
+
+
+def test_message_validation():
+    msg = nrm.messaging.message('downstreamEvent',
+                                {'tag': 'progress', 'payload': 3,
+                                 'application_uuid': 'a'})
+    assert msg.tag == 'progress'
+    assert msg.payload == 3
+    with pytest.raises(nrm.messaging.ValidationError):
+        nrm.messaging.message('downstreamEvent',
+                              {'tag': 'progress', 'application_uuid': 'a'})
+    with pytest.raises(nrm.messaging.ValidationError):
+        nrm.messaging.message('downstreamEvent', {'tag': 'list'})
+    msg = nrm.messaging.message('downstreamEvent', {'tag': 'list'},
+                                validate=False)
+    assert msg.tag == 'list'
+
+
+def test_down_event_trusted_callback(dummy_daemon):
+    server = nrm.messaging.DownstreamEventServer(
+            "ipc:///tmp/nrm-pytest-down-trusted", validate=False)
+    server.setup_recv_callback(dummy_daemon.callback)
+    server.do_recv_callback(['client', '{"tag": "progress", "payload": 1}'])
+    assert dummy_daemon.called
+    assert dummy_daemon.msg.payload == 1
+    assert dummy_daemon.client == 'client'
+
+
+@pytest.mark.parametrize("msg", [
+    {'tag': 'start', 'container_uuid': 'c', 'application_uuid': 'a'},
+    {'tag': 'exit', 'application_uuid': 'a'},
+    {'tag': 'performance', 'payload': 1.5, 'container_uuid': 'c',
+     'application_uuid': 'a'},
+    {'tag': 'progress', 'payload': 3.0, 'application_uuid': u'\xe9'},
+    {'tag': 'phasecontext', 'cpu': 3, 'startcompute': 1.0,
+     'endcompute': 2.0, 'startbarrier': 3.0, 'endbarrier': 4.0},
+    ])
+def test_binary_encoding(msg):
+    for encoding in nrm.messaging.encodings:
+        wire = nrm.messaging.encode('downstreamEvent', msg, encoding)
+        assert nrm.messaging.decode('downstreamEvent', wire) == msg
+    binary = nrm.messaging.encode('downstreamEvent', msg, 'binary')
+    assert len(binary) < len(nrm.messaging.encode('downstreamEvent', msg))
+    with pytest.raises(ValueError):
+        nrm.messaging.decode('downstreamEvent', binary[:-1])
+    with pytest.raises(ValueError):
+        nrm.messaging.decode('upstreamPub', binary)
+
+
+def test_down_event_binary_callback(dummy_daemon):
+    server = nrm.messaging.DownstreamEventServer(
+            "ipc:///tmp/nrm-pytest-down-binary")
+    server.setup_recv_callback(dummy_daemon.callback)
+    msg = {'tag': 'progress', 'payload': 1.0, 'application_uuid': 'a'}
+    server.do_recv_callback(
+            ['client', nrm.messaging.encode('downstreamEvent', msg,
+                                            'binary')])
+    assert dummy_daemon.msg == msg
+
+
+def test_binary_batch_encoding():
+    events = [{'tag': 'progress', 'payload': float(i),
+               'application_uuid': 'a'} for i in range(3)]
+    msg = {'tag': 'batch', 'events': events}
+    for encoding in nrm.messaging.encodings:
+        wire = nrm.messaging.encode('downstreamEvent', msg, encoding)
+        assert nrm.messaging.decode('downstreamEvent', wire) == msg
+    msg = nrm.messaging.message('downstreamEvent', msg)
+    assert [e.payload for e in msg.events] == [0.0, 1.0, 2.0]
+    with pytest.raises(nrm.messaging.ValidationError):
+        nrm.messaging.message('downstreamEvent',
+                              {'tag': 'batch', 'events': [{'tag': 'list'}]})
+
+
+def test_down_event_batch():
+    class _socket(object):
+        def __init__(self):
+            self.sent = []
+
+        def send(self, wire):
+            self.sent.append(nrm.messaging.decode('downstreamEvent', wire))
+
+    client = nrm.messaging.DownstreamEventClient(
+            "ipc:///tmp/nrm-pytest-down-batch", batch_size=3)
+    client.socket = _socket()
+    for i in range(4):
+        client.send(tag='progress', payload=i, application_uuid='a')
+    assert len(client.socket.sent) == 1
+    assert client.socket.sent[0]['tag'] == 'batch'
+    assert len(client.socket.sent[0]['events']) == 3
+    client.send(tag='exit', application_uuid='a')
+    assert len(client.socket.sent) == 2
+    assert [e['tag'] for e in client.socket.sent[1]['events']] == \
+        ['progress', 'exit']
+    client.flush()
+    assert len(client.socket.sent) == 2
+
+
+def test_pub_subscriptions():
+    server = nrm.messaging.UpstreamPubServer("ipc:///tmp/nrm-pytest-pub-sub")
+    clients = dict()
+    for name in ['all', 'power', 'container']:
+        clients[name] = nrm.messaging.UpstreamPubClient(
+                "ipc:///tmp/nrm-pytest-pub-sub")
+    clients['power'].subscribe_tag('power')
+    clients['container'].subscribe_container('c')
+    for client in clients.values():
+        client.connect()
+    msgs = [{'tag': 'power', 'total': 1.0, 'limit': 2.0},
+            {'tag': 'progress', 'payload': 1.0, 'application_uuid': 'a',
+             'container_uuid': 'c'},
+            {'tag': 'progress', 'payload': 1.0, 'application_uuid': 'a',
+             'container_uuid': 'cc'},
+            {'tag': 'exit', 'profile_data': {}, 'container_uuid': 'c'}]
+    # subscriptions reach the server asynchronously, wait for them
+    while not all(c.socket.poll(10) for c in clients.values()):
+        server.send(msgs[0])
+        server.send(msgs[3])
+    for client in clients.values():
+        while client.socket.poll(100):
+            client.recv()
+    for msg in msgs:
+        server.send(msg)
+    received = dict()
+    for name, client in clients.items():
+        received[name] = []
+        while client.socket.poll(100):
+            received[name].append(client.recv())
+    assert received['all'] == msgs
+    assert received['power'] == msgs[:1]
+    assert received['container'] == [msgs[1], msgs[3]]
+
+
+def test_rpc_server_hwm():
+    server = nrm.messaging.UpstreamRPCServer("ipc:///tmp/nrm-pytest-rpc-hwm",
+                                             hwm=2)
+    client = nrm.messaging.UpstreamRPCClient("ipc:///tmp/nrm-pytest-rpc-hwm")
+    client.socket.setsockopt(zmq.RCVHWM, 2)
+    client.connect()
+    client.socket.send('{"tag": "list"}')
+    assert server.socket.poll(1000)
+    server.socket.recv_multipart()
+    payload = 'x' * 65536
+    for i in range(64):
+        server.send(client.uuid, tag='stdout', container_uuid='c',
+                    payload=payload)
+    drained = server.drained(client.uuid)
+    assert not drained.done()
+    loop = ioloop.IOLoop.current()
+    received = 0
+    while received < 64:
+        if client.socket.poll(10):
+            assert client.recv().payload == payload
+            received += 1
+        loop.run_sync(lambda: gen.sleep(server.retry_period))
+    assert drained.done()
+    assert not server.pending
+    assert server.drained(client.uuid).done()
+    server.send('gone', tag='exit', container_uuid='c', status='0')
+    assert 'gone' not in server.pending
@@ -0,0 +1,107 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Output module."""
+import nrm
+import nrm.output
+import os
+from tornado import gen, ioloop, iostream
+
+
+def forward(chunks, write, **kwargs):
+    """Forward chunks written to a pipe, some time apart."""
+    r, w = os.pipe()
+    stream = iostream.PipeIOStream(r)
+    closed = []
+
+    @gen.coroutine
+    def run():
+        nrm.output.OutputForwarder(stream, write, lambda: closed.append(1),
+                                   **kwargs).start()
+        for chunk in chunks:
+            os.write(w, chunk)
+            yield gen.sleep(0.02)
+        os.close(w)
+        while not closed:
+            yield gen.sleep(0.01)
+    ioloop.IOLoop.current().run_sync(run)
+
+
+def test_coalesce():
+    batches = []
+    forward([b'a\nb', b'c\n', b'd'], batches.append, max_delay=1.0)
+    assert batches == [b'a\nbc\nd']
+
+
+def test_size_bound():
+    batches = []
+    forward([b'abc\nd', b'ef\ngh', b'i\n'], batches.append, max_size=4,
+            max_delay=1.0)
+    # batches end on lines, partial lines wait for the next batch
+    assert batches == [b'abc\n', b'def\n', b'ghi\n']
+
+
+def test_time_bound():
+    batches = []
+    forward([b'a\n', b'b\n'], batches.append, max_delay=0.001)
+    assert batches == [b'a\n', b'b\n']
+
+
+def test_spool(tmpdir):
+    path = nrm.output.spool_path(str(tmpdir), 'c', 'stdout')
+    spool = nrm.output.SpoolFile(path)
+    forward([b'a\n', b'b\n'], spool.write, max_delay=0.001)
+    ioloop.IOLoop.current().run_sync(spool.close)
+    assert tmpdir.join('c.stdout').read() == 'a\nb\n'
+
+
+def test_partial_line_after_size_flush():
+    batches = []
+    r, w = os.pipe()
+    stream = iostream.PipeIOStream(r)
+
+    @gen.coroutine
+    def run():
+        nrm.output.OutputForwarder(stream, batches.append, lambda: None,
+                                   max_size=16, max_delay=0.05).start()
+        # the child goes quiet after a prompt, without exiting
+        os.write(w, b'a' * 10 + b'\ntailX')
+        yield gen.sleep(0.2)
+    ioloop.IOLoop.current().run_sync(run)
+    os.close(w)
+    stream.close()
+    assert batches == [b'a' * 10 + b'\n', b'tailX']
+
+
+def test_timed_write_failure(caplog):
+    def write(data):
+        raise IOError("closed")
+    forward([b'a\n'], write, max_delay=0.001)
+    assert "could not write child output" in caplog.text
+
+
+def test_write_failure_done():
+    closed = []
+
+    def write(data):
+        raise IOError("closed")
+    r, w = os.pipe()
+
+    @gen.coroutine
+    def run():
+        nrm.output.OutputForwarder(iostream.PipeIOStream(r), write,
+                                   lambda: closed.append(1), max_size=2,
+                                   max_delay=1.0).start()
+        os.write(w, b'a\nb\n')
+        os.close(w)
+        yield gen.sleep(0.1)
+    ioloop.IOLoop.current().run_sync(run)
+    # the stream is still read to the end
+    assert closed == [1]
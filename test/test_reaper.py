@@ -0,0 +1,43 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Reaper module."""
+import nrm
+import nrm.reaper
+import os
+import subprocess
+import time
+from tornado import ioloop
+
+
+def test_reap_batches():
+    # keep the Popen objects, so that subprocess does not reap them
+    children = [subprocess.Popen(['true']) for i in range(3)]
+    # not a container process, the reaper must leave it alone
+    other = subprocess.Popen(['false'])
+    time.sleep(0.2)
+    batches = []
+    pids = set(c.pid for c in children)
+
+    def collect(batch):
+        # like the daemon, forget the children once reaped
+        batches.append(batch)
+        pids.difference_update(pid for pid, status, rusage in batch)
+    reaper = nrm.reaper.Reaper(collect, lambda: pids, batch_size=2)
+    reaper.reap()
+    # a full batch schedules the next one
+    assert len(batches) == 1 and len(batches[0]) == 2
+    assert reaper.scheduled
+    ioloop.IOLoop.current().run_sync(lambda: None)
+    assert not reaper.scheduled
+    reaped = [pid for batch in batches for pid, status, rusage in batch]
+    assert sorted(reaped) == sorted(c.pid for c in children)
+    assert all(os.WIFEXITED(s) for b in batches for p, s, r in b)
+    assert other.wait() == 1
@@ -0,0 +1,107 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Resources module."""
+import nrm
+import nrm.resources
+import nrm.subprograms
+import pytest
+import xml.etree.ElementTree
+from test_subprograms import TOPOLOGY
+
+resources = nrm.subprograms.resources
+
+
+@pytest.fixture
+def resource_manager(monkeypatch):
+    """Fixture for a resource manager on a dual socket node, with 4 cpus
+    and a NUMA node per socket."""
+    topology = nrm.subprograms.Topology(
+            xml.etree.ElementTree.fromstring(TOPOLOGY))
+    monkeypatch.setattr(nrm.subprograms.HwlocClient, 'load',
+                        lambda self: topology)
+    return nrm.resources.ResourceManager('hwloc')
+
+
+def test_masks():
+    assert nrm.resources._tomask([0, 3, 65]) == (1 << 65) | 9
+    assert nrm.resources._tolist((1 << 65) | 9) == [0, 3, 65]
+    assert nrm.resources._lowest(0b101100, 2) == 0b1100
+
+
+def test_schedule(resource_manager):
+    rm = resource_manager
+    assert rm.schedule('a', resources(3, 1)) == resources([0, 1, 2], [0])
+    assert rm.schedule('b', resources(2, 1)) == resources([3, 4], [1])
+    assert rm.available == resources([5, 6, 7], [])
+    assert rm.schedule('c', resources(4, 1)) == resources([], [])
+    rm.update('a')
+    assert rm.available == resources([0, 1, 2, 5, 6, 7], [0])
+    assert rm.schedule('c', resources(4, 1)) == resources([0, 1, 2, 5], [0])
+    assert 'a' not in rm.allocations
+    assert rm.allocations['c'] == resources([0, 1, 2, 5], [0])
+
+
+def test_placement_compact(resource_manager):
+    rm = resource_manager
+    assert rm.schedule('a', resources(1, 1), 'compact') == \
+        resources([0], [0])
+    # like first fit, the last free memory node is shared
+    assert rm.schedule('b', resources(2, 0), 'compact') == \
+        resources([1, 2], [1])
+    # the first package is too full, the request goes to the second one
+    assert rm.schedule('c', resources(2, 0), 'compact') == \
+        resources([4, 5], [])
+
+
+def test_placement_scatter(resource_manager):
+    assert resource_manager.schedule('a', resources(4, 2), 'scatter') == \
+        resources([0, 1, 4, 5], [0, 1])
+
+
+def test_placement_numa(resource_manager):
+    rm = resource_manager
+    rm.schedule('a', resources(1, 0), 'first')
+    # only the second node can hold the whole request
+    assert rm.schedule('b', resources(4, 1), 'numa') == \
+        resources([4, 5, 6, 7], [1])
+    assert rm.schedule('c', resources(2, 1), 'numa') == \
+        resources([1, 2], [0])
+    # no memory left, fall back to compact placement
+    assert rm.schedule('d', resources(1, 1), 'numa') == \
+        resources([3], [])
+
+
+def test_placement_bestfit(resource_manager):
+    rm = resource_manager
+    rm.schedule('a', resources(1, 0), 'first')
+    rm.schedule('b', resources(1, 0), 'first')
+    rm.schedule('c', resources(1, 0), 'first')
+    # the half-used core is filled before an empty one is broken up
+    assert rm.schedule('d', resources(1, 0), 'bestfit') == \
+        resources([3], [])
+    rm.update('b')
+    # a pair goes to the second package, leaving the single cpu alone
+    assert rm.schedule('e', resources(2, 0), 'bestfit') == \
+        resources([4, 5], [])
+    assert rm.schedule('f', resources(1, 0), 'bestfit') == \
+        resources([1], [])
+
+
+def test_report(resource_manager):
+    rm = resource_manager
+    assert rm.fragmentation() == 0.0
+    rm.schedule('a', resources(2, 0), 'scatter')
+    rm.schedule('b', resources(2, 0), 'bestfit')
+    report = rm.report()
+    assert report['cpus'] == 4
+    # cpus 1, 5, 6 and 7 are left: 3 of them in the same NUMA node
+    assert report['fragmentation'] == 0.25
+    assert report['largest_slice'] == {'cpus': [5, 6, 7], 'mems': [1]}
@@ -12,6 +12,7 @@
 import nrm
 import nrm.sensor
 import pytest
+import time
 
 
 @pytest.fixture
@@ -26,3 +27,23 @@ def test_sensor_update_returns_valid_data(sensor_manager):
     assert 'energy' in data
     assert 'power' in data['energy']
     assert 'total' in data['energy']['power']
+
+
+def test_sampler_publishes_snapshots():
+    """Ensure the sampler thread publishes fresh updates until stopped."""
+    class _sensor_manager(object):
+        def __init__(self):
+            self.count = 0
+
+        def do_update(self):
+            self.count += 1
+            return {'count': self.count}
+
+    sm = _sensor_manager()
+    sampler = nrm.sensor.SensorSampler(sm, 0.001)
+    sampler.start()
+    while not sampler.snapshot or sampler.snapshot['count'] < 3:
+        time.sleep(0.001)
+    sampler.stop()
+    assert not sampler.is_alive()
+    assert sampler.snapshot['count'] == sm.count
@@ -0,0 +1,54 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Simulation module."""
+import nrm
+import nrm.controller
+import nrm.simulation
+import pytest
+
+
+@pytest.fixture
+def sensor_manager():
+    """Fixture for a dual socket node with an imbalanced workload."""
+    models = {
+        'package-0': nrm.simulation.PowerModel([(0, 150.0)], noise=1.0),
+        'package-1': nrm.simulation.PowerModel([(0, 50.0), (90, 140.0)],
+                                               noise=1.0),
+        'package-0/dram': nrm.simulation.PowerModel([(0, 20.0)],
+                                                    controlled=False),
+    }
+    return nrm.simulation.SimulatedSensorManager(models, seed=0)
+
+
+def test_power_model_phases():
+    model = nrm.simulation.PowerModel([(10, 80.0), (0, 40.0)], lag=0)
+    assert model.demand(5) == 40.0
+    assert model.demand(10) == 80.0
+    assert model.step(10, 1.0, None) == 80.0
+    model.cap = 60.0
+    assert model.step(11, 1.0, None) == 60.0
+
+
+@pytest.mark.parametrize("engine", nrm.controller.control_engines.keys())
+def test_replay_convergence(sensor_manager, engine):
+    """Ensure the control loop tracks target changes in a few ticks."""
+    pa = nrm.controller.PowerActuator(
+            sensor_manager, nrm.controller.control_engines[engine]())
+    controller = nrm.controller.Controller([pa])
+    results = nrm.simulation.replay(controller, sensor_manager,
+                                    [(0, 200.0), (30, 150.0), (90, 260.0)],
+                                    120)
+    assert len(results['targets']) == 3
+    for r in results['targets']:
+        assert r['convergence'] is not None
+        assert r['convergence'] < 20
+        assert r['error'] < 5.0
+    assert results['cost']['max'] < 0.1
@@ -0,0 +1,127 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Subprograms module."""
+import nrm
+import nrm.subprograms
+import pytest
+from tornado import gen, ioloop
+
+
+@pytest.fixture
+def slow_nodeos(tmpdir):
+    """Fixture for a nodeos client whose commands take a while."""
+    script = tmpdir.join('argo_nodeos_config')
+    script.write("#!/bin/sh\nsleep 0.2\n")
+    script.chmod(0o755)
+    return nrm.subprograms.NodeOSClient(str(script))
+
+
+def test_async_commands(slow_nodeos):
+    """Ensure the event loop runs while runtime commands are pending."""
+    ticks = []
+    cb = ioloop.PeriodicCallback(lambda: ticks.append(1), 10)
+
+    @gen.coroutine
+    def run():
+        cb.start()
+        yield [slow_nodeos.create('test', nrm.subprograms.resources([0], [0])),
+               slow_nodeos.delete('test')]
+        cb.stop()
+
+    ioloop.IOLoop.current().run_sync(run)
+    assert len(ticks) > 5
+
+
+# two packages, each with its NUMA node, two cores and four PUs (hwloc 1.x)
+TOPOLOGY = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE topology SYSTEM "hwloc.dtd">
+<topology>
+  <object type="Machine" os_index="0" cpuset="0x000000ff">
+    <object type="NUMANode" os_index="0" cpuset="0x0000000f">
+      <object type="Package" os_index="0" cpuset="0x0000000f">
+        <object type="Core" os_index="0" cpuset="0x00000003">
+          <object type="PU" os_index="0" cpuset="0x00000001"/>
+          <object type="PU" os_index="1" cpuset="0x00000002"/>
+        </object>
+        <object type="Core" os_index="1" cpuset="0x0000000c">
+          <object type="PU" os_index="2" cpuset="0x00000004"/>
+          <object type="PU" os_index="3" cpuset="0x00000008"/>
+        </object>
+      </object>
+    </object>
+    <object type="NUMANode" os_index="1" cpuset="0x000000f0">
+      <object type="Package" os_index="1" cpuset="0x000000f0">
+        <object type="Core" os_index="0" cpuset="0x00000030">
+          <object type="PU" os_index="4" cpuset="0x00000010"/>
+          <object type="PU" os_index="5" cpuset="0x00000020"/>
+        </object>
+        <object type="Core" os_index="1" cpuset="0x000000c0">
+          <object type="PU" os_index="6" cpuset="0x00000040"/>
+          <object type="PU" os_index="7" cpuset="0x00000080"/>
+        </object>
+        <object type="Bridge" os_index="0"/>
+      </object>
+    </object>
+  </object>
+</topology>
+"""
+
+
+@pytest.fixture
+def topology():
+    """Fixture for a dual socket topology model."""
+    xmlroot = nrm.subprograms.xml.etree.ElementTree.fromstring(TOPOLOGY)
+    return nrm.subprograms.Topology(xmlroot)
+
+
+def test_bitmask2list():
+    assert nrm.subprograms.bitmask2list('0x00000005') == [0, 2]
+    assert nrm.subprograms.bitmask2list('0x00000001,0x00000000') == [32]
+
+
+def test_topology_resources(topology):
+    assert topology.resources() == nrm.subprograms.resources(range(8), [0, 1])
+    assert topology.mems(frozenset([1, 5])) == [0, 1]
+
+
+@pytest.mark.parametrize("n,restrict,expected", [
+    (1, None, [range(8)]),
+    (2, None, [range(4), range(4, 8)]),
+    (4, None, [[0, 1], [2, 3], [4, 5], [6, 7]]),
+    (8, None, [[i] for i in range(8)]),
+    (3, None, [[0, 1], [2, 3], range(4, 8)]),
+    (2, [2, 3, 4, 5], [[2, 3], [4, 5]]),
+    (2, [0, 1, 2, 3], [[0, 1], [2, 3]]),
+    ])
+def test_topology_distrib(topology, n, restrict, expected):
+    assert [sorted(c) for c in topology.distrib(n, restrict)] == expected
+
+
+def test_hwloc_cache(topology, tmpdir):
+    """Ensure the topology is only reloaded on cpu hotplug."""
+    online = tmpdir.join('online')
+    online.write('0-7\n')
+    client = nrm.subprograms.HwlocClient()
+    client.online = str(online)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return topology
+    client.load = load
+    dist = client.distrib(2)
+    assert dist == [nrm.subprograms.resources(range(4), [0]),
+                    nrm.subprograms.resources(range(4, 8), [1])]
+    client.info()
+    assert len(loads) == 1
+    online.write('0-3\n')
+    client.info()
+    assert len(loads) == 2
@@ -0,0 +1,54 @@
+###############################################################################
+# Copyright 2019 UChicago Argonne, LLC.
+# (c.f. AUTHORS, LICENSE)
+#
+# This file is part of the NRM project.
+# For more info, see https://xgitlab.cels.anl.gov/argo/nrm
+#
+# SPDX-License-Identifier: BSD-3-Clause
+###############################################################################
+
+"""Tests for the Telemetry module."""
+import nrm
+import nrm.telemetry
+import pytest
+
+
+@pytest.fixture
+def ring():
+    """Fixture for a small ring buffer."""
+    return nrm.telemetry.RingBuffer(4)
+
+
+def test_ring_empty(ring):
+    assert len(ring) == 0
+    assert ring.latest() is None
+    assert ring.mean(10) is None
+
+
+def test_ring_wraparound(ring):
+    """Ensure the oldest samples are overwritten, in order."""
+    for i in range(6):
+        ring.append(float(i), float(10 * i))
+    assert len(ring) == 4
+    times, values = ring.ordered()
+    assert list(times) == [2.0, 3.0, 4.0, 5.0]
+    assert list(values) == [20.0, 30.0, 40.0, 50.0]
+    assert ring.latest() == (5.0, 50.0)
+
+
+def test_ring_window_queries(ring):
+    for i in range(6):
+        ring.append(float(i), float(10 * i))
+    assert ring.mean(1) == 45.0
+    assert ring.max() == 50.0
+    assert ring.min(2) == 30.0
+    assert ring.percentile(50, now=4.0, seconds=1) == 35.0
+
+
+def test_store_keys():
+    store = nrm.telemetry.TelemetryStore(capacity=2)
+    store.append(('power', 'p0'), 1.0, 80.0)
+    store.append(('power', 'p0'), 2.0, 90.0)
+    assert store.get('power', 'p0').mean() == 85.0
+    assert store.get('power', 'p1') is None